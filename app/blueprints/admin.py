@@ -4,7 +4,9 @@ from ..services.project_service import ProjectService
 from ..services.user_service import UserService
 from ..services.system_settings_service import SystemSettingsService
 from ..services.microsoft_oauth_service import MicrosoftOAuthService
-import csv
+from ..services.export_service import ExportService
+from ..services.export_job_service import ExportJobService
+from ..utils.export_range import get_export_range, get_export_format, get_export_group_by
 import io
 import json
 import requests
@@ -21,7 +23,7 @@ def admin_panel():
         flash('Access denied. Admin privileges required.')
         return redirect(url_for('main.index'))
     
-    return render_template('admin.html')
+    return render_template('admin.html', export_formats=ExportService.get_formats())
 
 
 @admin_bp.route('/api/docs')
@@ -35,6 +37,46 @@ def api_docs():
     return render_template('api_docs.html')
 
 
+@admin_bp.route('/export_jobs', methods=['POST'])
+@login_required
+def create_organisation_export_job():
+    """Queue an export of every user's time; Excel gets one sheet per user or project"""
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Access denied. Admin privileges required.'})
+    
+    start_date, end_date, error = get_export_range()
+    if not error:
+        file_format, error = get_export_format(ExportService.get_formats())
+    if error:
+        return jsonify({'success': False, 'message': error})
+    
+    if file_format == 'xlsx':
+        group_by, error = get_export_group_by()
+        if error:
+            return jsonify({'success': False, 'message': error})
+        
+        job_id = ExportJobService.create_job(current_user.id, 'organisation', {
+            'start_date': start_date,
+            'end_date': end_date,
+            'group_by': group_by
+        })
+    else:
+        # Flat formats hold one row per user, project and day, so need no grouping
+        job_id = ExportJobService.create_job(current_user.id, 'records', {
+            'start_date': start_date,
+            'end_date': end_date,
+            'user_id': None,
+            'format': file_format
+        })
+    
+    # Status and download are served by the regular export job routes
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status_url': url_for('main.get_export_job', job_id=job_id)
+    }), 202
+
+
 @admin_bp.route('/projects')
 @login_required
 def project_management():
@@ -155,60 +197,29 @@ def upload_projects_csv():
         return redirect(url_for('admin.project_management'))
     
     try:
-        # Read the CSV file
-        stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None)
-        csv_input = csv.reader(stream)
+        # Parse the upload as it is read instead of decoding it whole
+        stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
+        success, result = ProjectService.import_projects_from_csv(stream)
         
-        # Skip header row if present
-        first_row = next(csv_input, None)
-        if not first_row:
-            flash('CSV file is empty.')
-            return redirect(url_for('admin.project_management'))
-        
-        # Check if first row looks like headers
-        if first_row[0].lower() in ['project_id', 'project id', 'id']:
-            # Skip header row
-            pass
-        else:
-            # First row is data, reset the stream
-            stream.seek(0)
-            csv_input = csv.reader(stream)
-        
-        added_count = 0
-        error_count = 0
-        errors = []
-        
-        for row_num, row in enumerate(csv_input, start=1):
-            if len(row) < 2:
-                error_count += 1
-                errors.append(f"Row {row_num}: Not enough columns (expected at least 2)")
-                continue
+        if success:
+            added_count = result['added_count']
+            updated_count = result['updated_count']
+            errors = result['errors']
             
-            project_id = row[0].strip().upper()
-            project_name = row[1].strip()
+            # Provide feedback
+            if added_count > 0:
+                flash(f'Successfully added {added_count} project(s).')
             
-            if not project_id or not project_name:
-                error_count += 1
-                errors.append(f"Row {row_num}: Missing project ID or name")
-                continue
+            if updated_count > 0:
+                flash(f'Updated {updated_count} existing project(s).')
             
-            success, message = ProjectService.add_project(project_id, project_name)
+            if errors:
+                flash(f'Skipped {result["error_count"]} row(s). Errors: {"; ".join(errors[:5])}{"..." if len(errors) > 5 else ""}')
             
-            if success:
-                added_count += 1
-            else:
-                error_count += 1
-                errors.append(f"Row {row_num}: {message}")
-        
-        # Provide feedback
-        if added_count > 0:
-            flash(f'Successfully added {added_count} project(s).')
-        
-        if error_count > 0:
-            flash(f'Failed to add {error_count} project(s). Errors: {"; ".join(errors[:5])}{"..." if len(errors) > 5 else ""}')
-        
-        if added_count == 0 and error_count == 0:
-            flash('No valid projects found in CSV file.')
+            if added_count == 0 and updated_count == 0 and not errors:
+                flash('No new or changed projects found in CSV file.')
+        else:
+            flash(f'Error processing CSV file: {result}')
     
     except Exception as e:
         flash(f'Error processing CSV file: {str(e)}')
@@ -744,19 +755,64 @@ Common Solutions:
         }
 
 
+def _css_response(compiled, cache_control):
+    """Build a stylesheet response, gzipped when the client accepts it"""
+    from flask import Response
+    
+    if request.accept_encodings['gzip']:
+        response = Response(compiled['gzip'], mimetype='text/css')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(compiled['css'], mimetype='text/css')
+    
+    response.vary.add('Accept-Encoding')
+    # Weak, since the gzip and identity bodies share one tag
+    response.set_etag(compiled['hash'], weak=True)
+    response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request)
+
+
+@admin_bp.app_context_processor
+def inject_custom_css_url():
+    """Expose the fingerprinted custom stylesheet URL to every template"""
+    from ..utils.customization import get_compiled_css
+    
+    try:
+        compiled = get_compiled_css(SystemSettingsService)
+        return {'custom_css_url': url_for('admin.custom_css_hashed', css_hash=compiled['hash'])}
+    except Exception:
+        return {'custom_css_url': url_for('admin.custom_css')}
+
+
 @admin_bp.route('/custom.css')
 def custom_css():
     """Serve custom CSS with dynamic variables"""
-    from ..utils.customization import generate_custom_css
+    from ..utils.customization import get_compiled_css
     from flask import Response
     
     try:
-        css = generate_custom_css(SystemSettingsService)
-        response = Response(css, mimetype='text/css')
         # Cache for 5 minutes
-        response.headers['Cache-Control'] = 'public, max-age=300'
-        return response
-    except Exception as e:
+        return _css_response(get_compiled_css(SystemSettingsService), 'public, max-age=300')
+    except Exception:
         # Return empty CSS on error
         return Response('/* Error generating custom CSS */', mimetype='text/css')
 
+
+@admin_bp.route('/custom.<css_hash>.css')
+def custom_css_hashed(css_hash):
+    """Serve custom CSS under a content-hashed URL that can be cached forever"""
+    from ..utils.customization import get_compiled_css
+    from flask import Response
+    
+    try:
+        compiled = get_compiled_css(SystemSettingsService)
+    except Exception:
+        return Response('/* Error generating custom CSS */', mimetype='text/css')
+    
+    if css_hash != compiled['hash']:
+        # A page rendered before the branding changed: serve the current
+        # stylesheet, but only cache it briefly under the old URL
+        return _css_response(compiled, 'public, max-age=300')
+    
+    return _css_response(compiled, 'public, max-age=31536000, immutable')
+
@@ -2,18 +2,216 @@
 API blueprint for Power BI and external integrations - Cursor-based pagination only
 """
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 from datetime import datetime
+import base64
+import hashlib
+import json
 from ..models.database import get_db_connection
 from ..utils.auth import require_api_key
+from ..utils.compression import init_compression
+from ..utils.conditional import etag_from_data_versions
+from ..utils.json_encoding import dumps
 
 api_bp = Blueprint('api', __name__)
+init_compression(api_bp)
+
+# Rows fetched from the cursor per chunk when streaming
+STREAM_CHUNK_SIZE = 500
+
+
+class InvalidPageToken(ValueError):
+    """Raised when a nextPageToken cannot be used for the current request"""
+
+
+def _filter_fingerprint(endpoint, filters):
+    """Short hash tying a page token to the endpoint and filters it was issued for"""
+    payload = json.dumps([endpoint, filters], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def _encode_page_token(endpoint, filters, after, delivered):
+    """Build an opaque keyset cursor pointing just past the last returned row"""
+    token = {
+        'after': after,
+        'n': delivered,
+        'f': _filter_fingerprint(endpoint, filters)
+    }
+    return base64.urlsafe_b64encode(json.dumps(token, separators=(',', ':')).encode()).decode()
+
+
+def _is_row_id(after):
+    """Cursor position for endpoints ordered by integer id"""
+    return isinstance(after, int) and not isinstance(after, bool)
+
+
+def _is_project_position(after):
+    """Cursor position for the projects endpoint: [total_minutes, project_id]"""
+    return (isinstance(after, list) and len(after) == 2
+            and isinstance(after[0], (int, float)) and not isinstance(after[0], bool)
+            and isinstance(after[1], str))
+
+
+def _decode_page_token(token, endpoint, filters, is_valid_after=_is_row_id):
+    """Decode a nextPageToken into (after, delivered, legacy_offset).
+    
+    Tokens issued before keyset pagination were a base64-encoded row offset;
+    those are still honoured so that in-flight refreshes can finish. The
+    cursor position must pass is_valid_after, so a tampered token is a 400
+    rather than a failing query.
+    """
+    if not token:
+        return None, 0, None
+    
+    try:
+        # Legacy tokens used the standard alphabet, whose '+' arrives as a space
+        # when the token is pasted into a URL unescaped
+        normalized = token.replace(' ', '+').replace('+', '-').replace('/', '_')
+        decoded = base64.urlsafe_b64decode(normalized.encode()).decode()
+        if decoded.isdigit():
+            return None, int(decoded), int(decoded)
+        cursor = json.loads(decoded)
+        after, delivered, fingerprint = cursor['after'], int(cursor['n']), cursor['f']
+    except (ValueError, KeyError, TypeError):
+        raise InvalidPageToken('Invalid nextPageToken')
+    
+    if fingerprint != _filter_fingerprint(endpoint, filters):
+        raise InvalidPageToken('nextPageToken was issued for different filters')
+    if not is_valid_after(after):
+        raise InvalidPageToken('Invalid nextPageToken')
+    
+    return after, delivered, None
+
+
+def _get_page_size():
+    """Get the requested page size, falling back to the default when out of range"""
+    try:
+        size = int(request.args.get('size', 2500))
+    except ValueError:
+        size = 2500
+    
+    # Max 5000 records per request
+    if size < 1 or size > 5000:
+        size = 2500
+    
+    return size
+
+
+def _build_timesheet_query(filters, after_id=None):
+    """Build the filtered timesheet query (without ORDER BY / LIMIT) and its params"""
+    query = '''
+        SELECT 
+            t.id,
+            t.user_id,
+            u.email as user_email,
+            t.date,
+            t.project_id,
+            t.project_name,
+            t.total_minutes,
+            ROUND(t.total_minutes / 60.0, 2) as total_hours,
+            t.last_updated,
+            u.is_admin
+        FROM timesheet t
+        JOIN users u ON t.user_id = u.id
+        WHERE 1=1
+    '''
+    
+    params = []
+    
+    # Add filters if provided
+    if filters['start_date']:
+        query += ' AND t.date >= ?'
+        params.append(filters['start_date'])
+        
+    if filters['end_date']:
+        query += ' AND t.date <= ?'
+        params.append(filters['end_date'])
+        
+    if filters['user_id']:
+        query += ' AND t.user_id = ?'
+        params.append(filters['user_id'])
+        
+    if filters['project_id']:
+        query += ' AND t.project_id = ?'
+        params.append(filters['project_id'])
+    
+    # Seek past the last id of the previous page instead of counting
+    # through an OFFSET, so every page costs the same
+    if after_id is not None:
+        query += ' AND t.id > ?'
+        params.append(after_id)
+    
+    return query, params
+
+
+def _timesheet_row_to_dict(row):
+    """Convert a timesheet query row to its API representation"""
+    return {
+        'id': row['id'],
+        'user_id': row['user_id'],
+        'user_email': row['user_email'],
+        'date': row['date'],
+        'project_id': row['project_id'],
+        'project_name': row['project_name'],
+        'total_minutes': row['total_minutes'],
+        'total_hours': row['total_hours'],
+        'last_updated': row['last_updated'],
+        'is_admin_user': bool(row['is_admin'])
+    }
+
+
+def _stream_timesheet_data(filters, after_id, output_format):
+    """Generate the filtered timesheet rows as NDJSON lines or a chunked JSON document.
+    
+    Rows are pulled from the cursor STREAM_CHUNK_SIZE at a time, so memory use
+    stays flat no matter how many rows match.
+    """
+    query, params = _build_timesheet_query(filters, after_id)
+    query += ' ORDER BY t.id'
+    
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(query, params)
+        
+        if output_format == 'json':
+            yield '{"data": ['
+        
+        count = 0
+        while True:
+            rows = cursor.fetchmany(STREAM_CHUNK_SIZE)
+            if not rows:
+                break
+            
+            encoded = [dumps(_timesheet_row_to_dict(row)) for row in rows]
+            if output_format == 'json':
+                yield (',' if count else '') + ','.join(encoded)
+            else:
+                yield '\n'.join(encoded) + '\n'
+            count += len(rows)
+        
+        if output_format == 'json':
+            metadata = {
+                'nextPageToken': None,
+                'size': count,
+                'offset': 0,
+                'hasMore': False,
+                'filters_applied': filters,
+                'generated_at': datetime.now().isoformat(),
+                'api_version': '2.0'
+            }
+            yield '], "metadata": ' + dumps(metadata) + '}'
+    finally:
+        conn.close()
 
 
 @api_bp.route('/powerbi/timesheet_data', methods=['GET'])
 @require_api_key
 def powerbi_timesheet_data():
-    """API endpoint for Power BI to get all timesheet data with cursor-based pagination"""
+    """API endpoint for Power BI to get all timesheet data with cursor-based pagination.
+    
+    Pass stream=1 to receive every matching row in one streamed response
+    instead of pages, as NDJSON (format=ndjson) or a single JSON document.
+    """
     
     # Get optional query parameters for filtering
     start_date = request.args.get('start_date')
@@ -21,67 +219,39 @@ def powerbi_timesheet_data():
     user_id = request.args.get('user_id')
     project_id = request.args.get('project_id')
     
+    filters = {
+        'start_date': start_date,
+        'end_date': end_date,
+        'user_id': user_id,
+        'project_id': project_id
+    }
+    
     # Get pagination parameters
-    size = int(request.args.get('size', 2500))
-    next_page_token = request.args.get('nextPageToken', '')
+    size = _get_page_size()
+    try:
+        after_id, offset, legacy_offset = _decode_page_token(
+            request.args.get('nextPageToken', ''), 'timesheet_data', filters
+        )
+    except InvalidPageToken as e:
+        return jsonify({'error': str(e)}), 400
     
-    # Validate size parameter
-    if size < 1 or size > 5000:  # Max 5000 records per request
-        size = 2500
+    output_format = request.args.get('format', 'json').lower()
+    if output_format not in ('json', 'ndjson'):
+        return jsonify({'error': 'format must be json or ndjson'}), 400
     
-    # Decode next_page_token to get offset (base64 encoded offset for security)
-    try:
-        if next_page_token:
-            import base64
-            offset = int(base64.b64decode(next_page_token.encode()).decode())
-        else:
-            offset = 0
-    except:
-        offset = 0
+    if request.args.get('stream') == '1' or output_format == 'ndjson':
+        mimetype = 'application/x-ndjson' if output_format == 'ndjson' else 'application/json'
+        return Response(
+            stream_with_context(_stream_timesheet_data(filters, after_id, output_format)),
+            mimetype=mimetype
+        )
     
     conn = get_db_connection()
     
     try:
-        # Build dynamic query based on filters
-        query = '''
-            SELECT 
-                t.id,
-                t.user_id,
-                u.email as user_email,
-                t.date,
-                t.project_id,
-                t.project_name,
-                t.total_minutes,
-                ROUND(t.total_minutes / 60.0, 2) as total_hours,
-                t.last_updated,
-                u.is_admin
-            FROM timesheet t
-            JOIN users u ON t.user_id = u.id
-            WHERE 1=1
-        '''
-        
-        params = []
-        
-        # Add filters if provided
-        if start_date:
-            query += ' AND t.date >= ?'
-            params.append(start_date)
-            
-        if end_date:
-            query += ' AND t.date <= ?'
-            params.append(end_date)
-            
-        if user_id:
-            query += ' AND t.user_id = ?'
-            params.append(user_id)
-            
-        if project_id:
-            query += ' AND t.project_id = ?'
-            params.append(project_id)
-        
-        # Order by id for consistent pagination
+        query, params = _build_timesheet_query(filters, after_id)
         query += ' ORDER BY t.id LIMIT ? OFFSET ?'
-        params.extend([size + 1, offset])  # Get one extra to check if there are more
+        params.extend([size + 1, legacy_offset or 0])  # Get one extra to check if there are more
         
         rows = conn.execute(query, params).fetchall()
         
@@ -91,27 +261,12 @@ def powerbi_timesheet_data():
             rows = rows[:-1]  # Remove the extra record
         
         # Convert to list of dictionaries
-        data = []
-        for row in rows:
-            data.append({
-                'id': row['id'],
-                'user_id': row['user_id'],
-                'user_email': row['user_email'],
-                'date': row['date'],
-                'project_id': row['project_id'],
-                'project_name': row['project_name'],
-                'total_minutes': row['total_minutes'],
-                'total_hours': row['total_hours'],
-                'last_updated': row['last_updated'],
-                'is_admin_user': bool(row['is_admin'])
-            })
+        data = [_timesheet_row_to_dict(row) for row in rows]
         
         # Generate next page token if there are more records
-        import base64
         next_token = None
         if has_more:
-            next_offset = offset + size
-            next_token = base64.b64encode(str(next_offset).encode()).decode()
+            next_token = _encode_page_token('timesheet_data', filters, data[-1]['id'], offset + len(data))
         
         # Build response in the format Power BI expects
         response = {
@@ -121,12 +276,7 @@ def powerbi_timesheet_data():
                 'size': len(data),
                 'offset': offset,
                 'hasMore': has_more,
-                'filters_applied': {
-                    'start_date': start_date,
-                    'end_date': end_date,
-                    'user_id': user_id,
-                    'project_id': project_id
-                },
+                'filters_applied': filters,
                 'generated_at': datetime.now().isoformat(),
                 'api_version': '2.0'
             }
@@ -143,24 +293,17 @@ def powerbi_timesheet_data():
 
 @api_bp.route('/powerbi/users', methods=['GET'])
 @require_api_key
+@etag_from_data_versions('users', 'timesheet')
 def powerbi_users_data():
     """API endpoint for Power BI users with cursor-based pagination"""
     
-    size = int(request.args.get('size', 2500))
-    next_page_token = request.args.get('nextPageToken', '')
-    
-    if size < 1 or size > 5000:
-        size = 2500
-    
-    # Decode offset from token
+    size = _get_page_size()
     try:
-        if next_page_token:
-            import base64
-            offset = int(base64.b64decode(next_page_token.encode()).decode())
-        else:
-            offset = 0
-    except:
-        offset = 0
+        after_id, offset, legacy_offset = _decode_page_token(
+            request.args.get('nextPageToken', ''), 'users', {}
+        )
+    except InvalidPageToken as e:
+        return jsonify({'error': str(e)}), 400
     
     conn = get_db_connection()
     
@@ -168,17 +311,19 @@ def powerbi_users_data():
         # Get users with one extra to check for more
         rows = conn.execute('''
             SELECT 
-                id,
-                email,
-                is_admin,
-                created_at,
-                (SELECT COUNT(*) FROM timesheet WHERE user_id = users.id) as total_entries,
-                (SELECT SUM(total_minutes) FROM timesheet WHERE user_id = users.id) as total_minutes,
-                (SELECT ROUND(SUM(total_minutes) / 60.0, 2) FROM timesheet WHERE user_id = users.id) as total_hours
-            FROM users
-            ORDER BY id
+                u.id,
+                u.email,
+                u.is_admin,
+                u.created_at,
+                ut.entry_count as total_entries,
+                ut.total_minutes,
+                ROUND(ut.total_minutes / 60.0, 2) as total_hours
+            FROM users u
+            LEFT JOIN user_totals ut ON u.id = ut.user_id
+            WHERE u.id > ?
+            ORDER BY u.id
             LIMIT ? OFFSET ?
-        ''', (size + 1, offset)).fetchall()
+        ''', (after_id or 0, size + 1, legacy_offset or 0)).fetchall()
         
         # Check if there are more records
         has_more = len(rows) > size
@@ -199,11 +344,9 @@ def powerbi_users_data():
             })
         
         # Generate next page token
-        import base64
         next_token = None
         if has_more:
-            next_offset = offset + size
-            next_token = base64.b64encode(str(next_offset).encode()).decode()
+            next_token = _encode_page_token('users', {}, data[-1]['id'], offset + len(data))
         
         response = {
             'data': data,
@@ -228,45 +371,49 @@ def powerbi_users_data():
 
 @api_bp.route('/powerbi/projects', methods=['GET'])
 @require_api_key
+@etag_from_data_versions('timesheet')
 def powerbi_projects_data():
     """API endpoint for Power BI projects with cursor-based pagination"""
     
-    size = int(request.args.get('size', 2500))
-    next_page_token = request.args.get('nextPageToken', '')
-    
-    if size < 1 or size > 5000:
-        size = 2500
-    
-    # Decode offset from token
+    size = _get_page_size()
     try:
-        if next_page_token:
-            import base64
-            offset = int(base64.b64decode(next_page_token.encode()).decode())
-        else:
-            offset = 0
-    except:
-        offset = 0
+        after, offset, legacy_offset = _decode_page_token(
+            request.args.get('nextPageToken', ''), 'projects', {}, _is_project_position
+        )
+    except InvalidPageToken as e:
+        return jsonify({'error': str(e)}), 400
     
     conn = get_db_connection()
     
     try:
+        # Seek past the (total_minutes, project_id) of the previous page's
+        # last row, matching the ORDER BY below
+        keyset_clause = ''
+        params = []
+        if after is not None:
+            keyset_clause = '''
+            WHERE pt.total_minutes < ?
+               OR (pt.total_minutes = ? AND pt.project_id > ?)'''
+            params.extend([after[0], after[0], after[1]])
+        params.extend([size + 1, legacy_offset or 0])
+        
         # Get projects with aggregated data
         rows = conn.execute('''
             SELECT 
-                project_id,
-                project_name,
-                COUNT(DISTINCT user_id) as unique_users,
-                COUNT(*) as total_entries,
-                SUM(total_minutes) as total_minutes,
-                ROUND(SUM(total_minutes) / 60.0, 2) as total_hours,
-                MIN(date) as first_entry_date,
-                MAX(date) as last_entry_date,
-                AVG(total_minutes) as avg_minutes_per_entry
-            FROM timesheet
-            GROUP BY project_id, project_name
-            ORDER BY total_minutes DESC
+                pt.project_id,
+                pt.project_name,
+                (SELECT COUNT(*) FROM project_user_totals pu
+                 WHERE pu.project_id = pt.project_id) as unique_users,
+                pt.entry_count as total_entries,
+                pt.total_minutes,
+                ROUND(pt.total_minutes / 60.0, 2) as total_hours,
+                pt.first_date as first_entry_date,
+                pt.last_date as last_entry_date,
+                pt.total_minutes * 1.0 / pt.entry_count as avg_minutes_per_entry
+            FROM project_totals pt''' + keyset_clause + '''
+            ORDER BY pt.total_minutes DESC, pt.project_id
             LIMIT ? OFFSET ?
-        ''', (size + 1, offset)).fetchall()
+        ''', params).fetchall()
         
         # Check if there are more records
         has_more = len(rows) > size
@@ -289,11 +436,12 @@ def powerbi_projects_data():
             })
         
         # Generate next page token
-        import base64
         next_token = None
         if has_more:
-            next_offset = offset + size
-            next_token = base64.b64encode(str(next_offset).encode()).decode()
+            last = data[-1]
+            next_token = _encode_page_token(
+                'projects', {}, [last['total_minutes'], last['project_id']], offset + len(data)
+            )
         
         response = {
             'data': data,
@@ -316,8 +464,117 @@ def powerbi_projects_data():
         conn.close()
 
 
+@api_bp.route('/powerbi/timesheet_changes', methods=['GET'])
+@require_api_key
+def powerbi_timesheet_changes():
+    """API endpoint for Power BI incremental refresh: timesheet rows changed since a watermark"""
+    
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'error': 'since must be an integer watermark'}), 400
+    
+    size = _get_page_size()
+    
+    conn = get_db_connection()
+    
+    try:
+        # Upserts are current rows stamped after the watermark, deletes come
+        # from tombstones; both share the same change sequence
+        rows = conn.execute('''
+            SELECT * FROM (
+                SELECT 
+                    t.change_seq,
+                    'upsert' as operation,
+                    t.id,
+                    t.user_id,
+                    u.email as user_email,
+                    t.date,
+                    t.project_id,
+                    t.project_name,
+                    t.total_minutes,
+                    ROUND(t.total_minutes / 60.0, 2) as total_hours,
+                    t.last_updated,
+                    u.is_admin
+                FROM timesheet t
+                JOIN users u ON t.user_id = u.id
+                WHERE t.change_seq > ?
+                UNION ALL
+                SELECT 
+                    d.change_seq,
+                    'delete' as operation,
+                    d.timesheet_id,
+                    d.user_id,
+                    NULL,
+                    d.date,
+                    d.project_id,
+                    NULL,
+                    NULL,
+                    NULL,
+                    d.deleted_at,
+                    NULL
+                FROM timesheet_tombstones d
+                WHERE d.change_seq > ?
+            )
+            ORDER BY change_seq
+            LIMIT ?
+        ''', (since, since, size + 1)).fetchall()
+        
+        has_more = len(rows) > size
+        if has_more:
+            rows = rows[:-1]
+        
+        data = []
+        for row in rows:
+            data.append({
+                'change_seq': row['change_seq'],
+                'operation': row['operation'],
+                'id': row['id'],
+                'user_id': row['user_id'],
+                'user_email': row['user_email'],
+                'date': row['date'],
+                'project_id': row['project_id'],
+                'project_name': row['project_name'],
+                'total_minutes': row['total_minutes'],
+                'total_hours': row['total_hours'],
+                'last_updated': row['last_updated'],
+                'is_admin_user': bool(row['is_admin']) if row['is_admin'] is not None else None
+            })
+        
+        # Pass the returned watermark as 'since' on the next call; while
+        # hasMore is true keep paging before storing it
+        if data:
+            watermark = data[-1]['change_seq']
+        else:
+            current = conn.execute('''
+                SELECT version FROM data_versions WHERE name = 'timesheet'
+            ''').fetchone()
+            watermark = max(since, current['version'] if current else 0)
+        
+        response = {
+            'data': data,
+            'metadata': {
+                'since': since,
+                'watermark': watermark,
+                'size': len(data),
+                'hasMore': has_more,
+                'generated_at': datetime.now().isoformat(),
+                'api_version': '2.0'
+            }
+        }
+        
+        return jsonify(response)
+        
+    except Exception as e:
+        print(f"Power BI Changes API error: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+    finally:
+        conn.close()
+
+
 @api_bp.route('/powerbi/summary', methods=['GET'])
 @require_api_key
+@etag_from_data_versions('timesheet')
 def powerbi_summary_data():
     """API endpoint for Power BI to get overall summary statistics"""
     
@@ -327,27 +584,26 @@ def powerbi_summary_data():
         # Get overall statistics
         summary = conn.execute('''
             SELECT 
-                COUNT(*) as total_entries,
-                COUNT(DISTINCT user_id) as total_users,
-                COUNT(DISTINCT project_id) as total_projects,
+                COALESCE(SUM(entry_count), 0) as total_entries,
+                (SELECT COUNT(*) FROM user_totals) as total_users,
+                (SELECT COUNT(*) FROM project_totals) as total_projects,
                 SUM(total_minutes) as total_minutes,
                 ROUND(SUM(total_minutes) / 60.0, 2) as total_hours,
                 MIN(date) as earliest_entry,
                 MAX(date) as latest_entry,
-                AVG(total_minutes) as avg_minutes_per_entry
-            FROM timesheet
+                SUM(total_minutes) * 1.0 / SUM(entry_count) as avg_minutes_per_entry
+            FROM daily_totals
         ''').fetchone()
         
         # Get recent activity (last 30 days)
         recent_activity = conn.execute('''
             SELECT 
                 date,
-                COUNT(*) as entries_count,
-                SUM(total_minutes) as daily_minutes,
-                ROUND(SUM(total_minutes) / 60.0, 2) as daily_hours
-            FROM timesheet
+                entry_count as entries_count,
+                total_minutes as daily_minutes,
+                ROUND(total_minutes / 60.0, 2) as daily_hours
+            FROM daily_totals
             WHERE date >= date('now', '-30 days')
-            GROUP BY date
             ORDER BY date DESC
             LIMIT 30
         ''').fetchall()
@@ -407,7 +663,8 @@ def powerbi_api_info():
             'nextPageToken': {
                 'description': 'Token for next page (from previous response metadata)',
                 'type': 'string',
-                'note': 'Omit for first page, use value from previous response for subsequent pages'
+                'note': 'Omit for first page, use value from previous response for subsequent pages. '
+                        'Tokens are keyset cursors bound to the filters they were issued with.'
             }
         },
         'endpoints': {
@@ -417,9 +674,18 @@ def powerbi_api_info():
                     'start_date': 'Filter by start date (YYYY-MM-DD)',
                     'end_date': 'Filter by end date (YYYY-MM-DD)',
                     'user_id': 'Filter by specific user ID',
-                    'project_id': 'Filter by specific project ID'
+                    'project_id': 'Filter by specific project ID',
+                    'stream': 'Set to 1 to stream every matching row in one response instead of pages',
+                    'format': 'json (default) or ndjson; ndjson always streams one record per line'
                 }
             },
+            '/api/powerbi/timesheet_changes': {
+                'description': 'Get timesheet rows inserted, updated or deleted since a watermark',
+                'filters': {
+                    'since': 'Watermark from a previous response (omit or 0 for everything)'
+                },
+                'note': 'Page with since=metadata.watermark while metadata.hasMore is true, then store the watermark for the next refresh'
+            },
             '/api/powerbi/users': {
                 'description': 'Get user data with aggregated timesheet statistics'
             },
@@ -479,7 +745,7 @@ in
                 'metadata': {
                     'nextPageToken': 'Token for next page (null if last page)',
                     'size': 'Number of records in current response',
-                    'offset': 'Current offset in dataset',
+                    'offset': 'Number of records returned by earlier pages',
                     'hasMore': 'Boolean indicating if more pages exist',
                     'generated_at': 'ISO timestamp of response generation',
                     'api_version': 'API version number'
@@ -490,6 +756,8 @@ in
             'timesheet_basic': '/api/powerbi/timesheet_data?size=1000',
             'timesheet_filtered': '/api/powerbi/timesheet_data?start_date=2025-01-01&end_date=2025-12-31&size=2500',
             'timesheet_next_page': '/api/powerbi/timesheet_data?size=2500&nextPageToken=Mg==',
+            'timesheet_changes': '/api/powerbi/timesheet_changes?since=0&size=2500',
+            'timesheet_stream': '/api/powerbi/timesheet_data?format=ndjson&stream=1',
             'users': '/api/powerbi/users?size=500',
             'projects': '/api/powerbi/projects?size=100'
         },
@@ -2,18 +2,38 @@
 Main application blueprint for timesheet functionality
 """
 
-from flask import Blueprint, render_template, request, jsonify, send_file
+from flask import Blueprint, render_template, request, jsonify, send_file, Response, url_for
 from flask_login import login_required, current_user
 from datetime import datetime
+import os
 import threading
 import time
 from ..services.timesheet_service import TimesheetService
 from ..services.project_service import ProjectService
 from ..services.export_service import ExportService
+from ..services.export_job_service import ExportJobService
 from ..services.system_settings_service import SystemSettingsService
+from ..models.database import get_data_versions
+from ..utils.json_encoding import dumps
+from ..utils.export_range import get_export_range, get_export_format
 
 main_bp = Blueprint('main', __name__)
 
+# Tracking event streams: how often an open stream checks the tracking
+# version (to see changes made by other worker processes), how often it sends
+# a keep-alive comment, and how long before the browser is asked to reconnect
+EVENT_CHECK_INTERVAL = 15
+EVENT_HEARTBEAT_INTERVAL = 30
+EVENT_STREAM_LIFETIME = 300
+
+# Each open stream holds a gunicorn thread for up to EVENT_STREAM_LIFETIME, so
+# only this many run per process; tabs that are refused poll instead
+EVENT_MAX_STREAMS = int(os.getenv('EVENT_MAX_STREAMS', 4))
+
+# Wakes this process's open streams as soon as a user starts or stops tracking
+_tracking_changed = threading.Condition()
+_stream_slots = threading.BoundedSemaphore(EVENT_MAX_STREAMS)
+
 # Health check endpoint for Docker containers
 @main_bp.route('/health')
 def health_check():
@@ -33,28 +53,6 @@ def health_check():
             'timestamp': datetime.utcnow().isoformat()
         }), 503
 
-# Global variables for tracking
-current_project = None
-start_time = None
-sync_thread = None
-stop_sync = False
-
-
-def sync_current_time():
-    """Background thread to sync current time every minute"""
-    global current_project, start_time, stop_sync
-    
-    while not stop_sync:
-        # Just wait - we'll only log when tracking stops
-        # This simplifies the logic and prevents double-counting
-        
-        # Wait for 60 seconds
-        for _ in range(60):
-            if stop_sync:
-                break
-            time.sleep(1)
-
-
 def _get_customization_settings():
     """Get customization settings for templates"""
     try:
@@ -89,14 +87,16 @@ def index():
     available_projects = ProjectService.get_available_projects(today, current_user.id)
     aggregates = TimesheetService.get_daily_aggregate(today, current_user.id)
     customization = _get_customization_settings()
+    active = TimesheetService.get_active_tracking(current_user.id)
     
     return render_template('index.html', 
                          selected_projects=selected_projects,
                          available_projects=available_projects,
                          aggregates=aggregates,
-                         current_project=current_project,
+                         current_project=active['project_id'] if active else None,
                          selected_date=today,
-                         customization=customization)
+                         customization=customization,
+                         export_formats=ExportService.get_formats())
 
 
 @main_bp.route('/date/<date_str>')
@@ -107,14 +107,16 @@ def index_date(date_str):
     available_projects = ProjectService.get_available_projects(date_str, current_user.id)
     aggregates = TimesheetService.get_daily_aggregate(date_str, current_user.id)
     customization = _get_customization_settings()
+    active = TimesheetService.get_active_tracking(current_user.id)
     
     return render_template('index.html', 
                          selected_projects=selected_projects,
                          available_projects=available_projects,
                          aggregates=aggregates,
-                         current_project=current_project,
+                         current_project=active['project_id'] if active else None,
                          selected_date=date_str,
-                         customization=customization)
+                         customization=customization,
+                         export_formats=ExportService.get_formats())
 
 
 @main_bp.route('/view_date/<date_str>')
@@ -133,38 +135,36 @@ def view_date(date_str):
                          aggregates=aggregates,
                          entries=entries,
                          selected_date=date_str,
-                         customization=customization)
+                         customization=customization,
+                         export_formats=ExportService.get_formats())
+
+
+def _notify_tracking_changed():
+    """Wake the tracking event streams in this process"""
+    with _tracking_changed:
+        _tracking_changed.notify_all()
+
+
+def _tracking_status(active):
+    """Describe a running timer (or its absence) for the browser"""
+    if not active:
+        return {'tracking': False}
+    
+    return {
+        'tracking': True,
+        'project_id': active['project_id'],
+        'started_at': active['started_at'].isoformat(),
+        'elapsed_seconds': round((datetime.now() - active['started_at']).total_seconds(), 1)
+    }
 
 
 def _stop_tracking_internal():
     """Internal function to stop tracking without HTTP response"""
-    global current_project, start_time, stop_sync
-    
-    if not current_project or not start_time:
+    tracked_project = TimesheetService.stop_active_tracking(current_user.id)
+    if not tracked_project:
         return False
     
-    # Stop sync thread
-    stop_sync = True
-    
-    end_time = datetime.now()
-    today = datetime.now().strftime('%Y-%m-%d')
-    projects = ProjectService.get_projects()
-    
-    # Log the final time entry
-    TimesheetService.log_time_entry(
-        current_project, 
-        projects.get(current_project, 'Unknown'), 
-        start_time, 
-        end_time, 
-        today, 
-        current_user.id
-    )
-    
-    # Reset tracking variables
-    tracked_project = current_project
-    current_project = None
-    start_time = None
-    
+    _notify_tracking_changed()
     return tracked_project
 
 
@@ -172,28 +172,17 @@ def _stop_tracking_internal():
 @login_required
 def start_tracking():
     """Start time tracking for a project"""
-    global current_project, start_time, sync_thread, stop_sync
-    
     data = request.get_json()
     if not data:
         return jsonify({'success': False, 'message': 'Invalid request data'})
     
     project_id = data.get('project_id')
+    if not project_id:
+        return jsonify({'success': False, 'message': 'Invalid request data'})
     
-    # Stop any existing tracking first
-    previous_project = None
-    if current_project:
-        previous_project = _stop_tracking_internal()
-    
-    # Start tracking the new project
-    current_project = project_id
-    start_time = datetime.now()
-    
-    # Start sync thread
-    stop_sync = False
-    sync_thread = threading.Thread(target=sync_current_time)
-    sync_thread.daemon = True
-    sync_thread.start()
+    # Stops and logs any existing tracking first
+    previous_project = TimesheetService.start_active_tracking(current_user.id, project_id)
+    _notify_tracking_changed()
     
     message = f'Started tracking {project_id}'
     if previous_project:
@@ -206,9 +195,6 @@ def start_tracking():
 @login_required
 def stop_tracking():
     """Stop time tracking"""
-    if not current_project or not start_time:
-        return jsonify({'success': False, 'message': 'No active tracking'})
-    
     tracked_project = _stop_tracking_internal()
     
     if tracked_project:
@@ -221,17 +207,73 @@ def stop_tracking():
 @login_required
 def get_current_status():
     """Get current tracking status"""
-    if current_project and start_time:
-        elapsed = datetime.now() - start_time
+    active = TimesheetService.get_active_tracking(current_user.id)
+    if active:
+        elapsed = datetime.now() - active['started_at']
         elapsed_minutes = elapsed.total_seconds() / 60
         return jsonify({
             'tracking': True,
-            'project_id': current_project,
+            'project_id': active['project_id'],
             'elapsed_minutes': round(elapsed_minutes, 2)
         })
     return jsonify({'tracking': False})
 
 
+@main_bp.route('/tracking_events')
+@login_required
+def tracking_events():
+    """Server-Sent Events stream of the current user's tracking status"""
+    user_id = current_user.id
+    
+    if not _stream_slots.acquire(blocking=False):
+        return Response('Too many open status streams\n', status=503, mimetype='text/plain',
+                        headers={'Retry-After': str(EVENT_STREAM_LIFETIME)})
+    
+    def generate():
+        # Runs after the request context is gone, so each lookup borrows a
+        # pooled connection only for the duration of the query
+        deadline = time.monotonic() + EVENT_STREAM_LIFETIME
+        last_sent = time.monotonic()
+        version = get_data_versions('tracking')
+        active = TimesheetService.get_active_tracking(user_id)
+        
+        yield 'retry: 2000\n'
+        yield f'event: status\ndata: {dumps(_tracking_status(active))}\n\n'
+        
+        while time.monotonic() < deadline:
+            with _tracking_changed:
+                _tracking_changed.wait(EVENT_CHECK_INTERVAL)
+            
+            # One primary key read; active_tracking is only read again once
+            # some user's timer has actually changed
+            current_version = get_data_versions('tracking')
+            previous = active
+            if current_version != version:
+                version = current_version
+                active = TimesheetService.get_active_tracking(user_id)
+            
+            if active != previous:
+                if not active:
+                    event = 'stop'
+                elif not previous:
+                    event = 'start'
+                else:
+                    event = 'switch'
+                last_sent = time.monotonic()
+                yield f'event: {event}\ndata: {dumps(_tracking_status(active))}\n\n'
+            elif time.monotonic() - last_sent >= EVENT_HEARTBEAT_INTERVAL:
+                last_sent = time.monotonic()
+                yield ': keep-alive\n\n'
+    
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Runs when the server closes the response, even if the stream never started
+    response.call_on_close(_stream_slots.release)
+    return response
+
+
 @main_bp.route('/add_project', methods=['POST'])
 @login_required
 def add_project():
@@ -301,31 +343,79 @@ def delete_entry():
         return jsonify({'success': False, 'message': 'Entry not found'})
 
 
+def _export_job_status(job):
+    """Describe an export job for the browser"""
+    status = {
+        'job_id': job['id'],
+        'status': job['status'],
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at']
+    }
+    if job['status'] == 'done':
+        status['download_url'] = url_for('main.download_export_job', job_id=job['id'])
+    if job['status'] == 'failed':
+        status['message'] = 'Error generating export file'
+    return status
+
+
+@main_bp.route('/export_jobs', methods=['POST'])
+@login_required
+def create_export_job():
+    """Queue an export of the user's time tracking data in the requested format"""
+    start_date, end_date, error = get_export_range()
+    if not error:
+        file_format, error = get_export_format(ExportService.get_formats())
+    if error:
+        return jsonify({'success': False, 'message': error})
+    
+    params = {
+        'start_date': start_date,
+        'end_date': end_date,
+        'user_id': current_user.id
+    }
+    if file_format == 'xlsx':
+        job_id = ExportJobService.create_job(current_user.id, 'excel', params)
+    else:
+        job_id = ExportJobService.create_job(current_user.id, 'records', {**params, 'format': file_format})
+    
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status_url': url_for('main.get_export_job', job_id=job_id)
+    }), 202
+
+
+@main_bp.route('/export_jobs/<job_id>')
+@login_required
+def get_export_job(job_id):
+    """Get the status of one of the user's export jobs"""
+    job = ExportJobService.get_job(job_id, current_user.id)
+    if not job:
+        return jsonify({'success': False, 'message': 'Export not found'}), 404
+    
+    return jsonify({'success': True, **_export_job_status(job)})
+
+
+@main_bp.route('/export_jobs/<job_id>/download')
+@login_required
+def download_export_job(job_id):
+    """Download a finished export"""
+    job = ExportJobService.get_job(job_id, current_user.id)
+    if not job or job['status'] != 'done' or not os.path.exists(job['file_path']):
+        return jsonify({'success': False, 'message': 'Export not found'}), 404
+    
+    return send_file(job['file_path'], as_attachment=True, download_name=job['filename'])
+
+
 @main_bp.route('/export_excel', methods=['POST'])
 @login_required
 def export_excel():
     """Export user's time tracking data to Excel"""
-    # Handle both JSON and form data
-    if request.is_json:
-        data = request.get_json()
-        start_date = data.get('start_date') if data else None
-        end_date = data.get('end_date') if data else None
-    else:
-        # Handle form data
-        start_date = request.form.get('start_date')
-        end_date = request.form.get('end_date')
-    
-    if not start_date or not end_date:
-        return jsonify({'success': False, 'message': 'Please provide both start and end dates'})
+    start_date, end_date, error = get_export_range()
+    if error:
+        return jsonify({'success': False, 'message': error})
     
     try:
-        # Validate date format
-        datetime.strptime(start_date, '%Y-%m-%d')
-        datetime.strptime(end_date, '%Y-%m-%d')
-        
-        if start_date > end_date:
-            return jsonify({'success': False, 'message': 'Start date must be before end date'})
-        
         # Generate Excel file
         excel_file = ExportService.generate_excel_export(start_date, end_date, current_user.id)
         
@@ -339,8 +429,6 @@ def export_excel():
             mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
         )
         
-    except ValueError:
-        return jsonify({'success': False, 'message': 'Invalid date format'})
     except Exception as e:
         print(f"Export error: {e}")
         return jsonify({'success': False, 'message': 'Error generating export file'})
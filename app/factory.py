@@ -26,8 +26,17 @@ def create_app(config_name='default'):
                 template_folder=template_dir,
                 static_folder=static_dir)
     
+    # Serialize JSON with orjson when it is installed
+    from .utils.json_encoding import FastJSONProvider
+    app.json = FastJSONProvider(app)
+    
     # Configure app
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
+    # Previous secret keys, still accepted for sessions and encrypted settings
+    # until `flask rotate-settings-key` has re-encrypted them
+    app.config['SECRET_KEY_FALLBACKS'] = [
+        key.strip() for key in os.getenv('SECRET_KEY_FALLBACKS', '').split(',') if key.strip()
+    ]
     app.config['DATABASE'] = os.getenv('DATABASE', 'timesheet.db')
     
     # Configure logging for production
@@ -45,10 +54,17 @@ def create_app(config_name='default'):
     init_login_manager(app)
     
     # Initialize database
-    from .models.database import init_database, create_admin_user, ensure_oauth_settings_exist
+    from .models.database import init_app as init_db, init_database
+    init_db(app)
     init_database()
-    create_admin_user()
-    ensure_oauth_settings_exist()
+    
+    # Optionally stop timers that run past midnight (off by default)
+    from .services.timesheet_service import start_auto_stop_task
+    start_auto_stop_task(int(os.getenv('TRACKING_AUTO_STOP_INTERVAL', 0)))
+    
+    # Expire export files even when nobody starts a new export
+    from .services.export_job_service import start_cleanup_task
+    start_cleanup_task(int(os.getenv('EXPORT_CLEANUP_INTERVAL', 300)))
     
     # Register blueprints
     from .blueprints.auth import auth_bp
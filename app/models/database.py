@@ -4,265 +4,317 @@ Database utilities and initialization for Timesheet Tracker
 
 import sqlite3
 import os
+import queue
+import threading
+import time
+import click
+from flask import g, has_app_context
 from .user import hash_password
 
 
-def get_db_connection():
-    """Get database connection"""
-    database_path = os.getenv('DATABASE', 'timesheet.db')
-    conn = sqlite3.connect(database_path)
-    conn.row_factory = sqlite3.Row
-    return conn
+_pools = {}
+_pools_lock = threading.Lock()
+_checkpoint_thread = None
 
 
-def init_database():
-    """Initialize database with required tables"""
-    conn = get_db_connection()
+def get_pragma_profile():
+    """PRAGMAs applied once when a pooled connection is first opened.
+    
+    WAL lets Power BI reads and time tracking writes run concurrently across
+    gunicorn workers; each value can be overridden from the environment.
+    """
+    return [
+        ('journal_mode', os.getenv('DB_JOURNAL_MODE', 'WAL')),
+        ('synchronous', os.getenv('DB_SYNCHRONOUS', 'NORMAL')),
+        ('busy_timeout', int(os.getenv('DB_BUSY_TIMEOUT', 5000))),
+        ('cache_size', int(os.getenv('DB_CACHE_SIZE', -16000))),  # negative = KiB
+        ('mmap_size', int(os.getenv('DB_MMAP_SIZE', 134217728))),
+        ('temp_store', os.getenv('DB_TEMP_STORE', 'MEMORY')),
+    ]
+
+
+class ConnectionPool:
+    """Bounded pool of reusable SQLite connections for a single database file.
     
-    # Create users table with all current fields including 2FA support
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            is_admin INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            temp_password TEXT NULL,
-            is_disabled INTEGER DEFAULT 0,
-            microsoft_id TEXT NULL,
-            display_name TEXT NULL,
-            auth_method TEXT DEFAULT 'password',
-            password_disabled INTEGER DEFAULT 0,
-            totp_secret TEXT NULL,
-            totp_enabled INTEGER DEFAULT 0,
-            backup_codes TEXT NULL
-        )
-    ''')
+    At most max_size idle connections are kept for reuse, and at most
+    max_connections are checked out at once; further callers wait up to
+    timeout seconds for one to be released.
+    """
     
-    # Check if we need to add new columns to existing users table
-    cursor = conn.cursor()
-    cursor.execute("PRAGMA table_info(users)")
-    existing_columns = [column[1] for column in cursor.fetchall()]
+    def __init__(self, database_path, max_size=5, max_connections=20, timeout=30):
+        self.database_path = database_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=max_size)
+        self._checkouts = threading.BoundedSemaphore(max(max_connections, 1))
     
-    # Define all columns that should exist
-    required_columns = [
-        ('temp_password', 'TEXT NULL'),
-        ('is_disabled', 'INTEGER DEFAULT 0'),
-        ('microsoft_id', 'TEXT NULL'),
-        ('display_name', 'TEXT NULL'),
-        ('auth_method', 'TEXT DEFAULT "password"'),
-        ('password_disabled', 'INTEGER DEFAULT 0'),
-        ('totp_secret', 'TEXT NULL'),
-        ('totp_enabled', 'INTEGER DEFAULT 0'),
-        ('backup_codes', 'TEXT NULL')
-    ]
+    def _create_connection(self):
+        """Open a new connection and apply the PRAGMA profile"""
+        # Connections move between threads via the pool, but are only ever
+        # used by one thread at a time
+        conn = sqlite3.connect(self.database_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma, value in get_pragma_profile():
+            conn.execute(f'PRAGMA {pragma} = {value}')
+        return conn
+    
+    def acquire(self):
+        """Take an idle connection from the pool or open a new one.
+        
+        Raises sqlite3.OperationalError if every connection stays checked out
+        for the whole timeout.
+        """
+        if not self._checkouts.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError('Timed out waiting for a database connection')
+        
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        try:
+            return self._create_connection()
+        except BaseException:
+            self._checkouts.release()
+            raise
     
-    # Add missing columns
-    for column_name, column_def in required_columns:
-        if column_name not in existing_columns:
+    def release(self, conn):
+        """Return a connection to the pool, closing it if the pool is full"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
             try:
-                alter_sql = f'ALTER TABLE users ADD COLUMN {column_name} {column_def}'
-                print(f"Adding column: {alter_sql}")
-                conn.execute(alter_sql)
-                conn.commit()
-                print(f"Successfully added column: {column_name}")
-            except sqlite3.OperationalError as e:
-                print(f"Error adding column {column_name}: {e}")
-                # Column might already exist, continue
-                pass
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+        finally:
+            self._checkouts.release()
     
-    # Create timesheet table with user_id
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS timesheet (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            date TEXT NOT NULL,
-            project_id TEXT NOT NULL,
-            project_name TEXT NOT NULL,
-            total_minutes REAL DEFAULT 0,
-            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            UNIQUE(user_id, date, project_id)
-        )
-    ''')
+    def close_all(self):
+        """Close every idle connection held by the pool"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class PooledConnection:
+    """Handle around a pooled connection.
     
-    # Create daily_projects table with user_id
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS daily_projects (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            date TEXT NOT NULL,
-            project_id TEXT NOT NULL,
-            project_name TEXT NOT NULL,
-            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            UNIQUE(user_id, date, project_id)
-        )
-    ''')
+    Behaves like a sqlite3 connection, but close() hands the connection back
+    instead of tearing it down. Inside a Flask app context one handle is shared
+    by every service call for the rest of the request and released in the
+    teardown hook.
+    """
     
-    # Create projects table for project management
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS projects (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            project_id TEXT UNIQUE NOT NULL,
-            project_name TEXT NOT NULL,
-            status TEXT DEFAULT 'live' CHECK(status IN ('live', 'finished')),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+    def __init__(self, conn, pool, request_scoped=False):
+        self._conn = conn
+        self._pool = pool
+        self._request_scoped = request_scoped
+        self._depth = 0
     
-    # Create system_settings table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS system_settings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            setting_key TEXT UNIQUE NOT NULL,
-            setting_value TEXT NULL,
-            setting_type TEXT DEFAULT 'text',
-            is_encrypted INTEGER DEFAULT 0,
-            description TEXT NULL,
-            category TEXT DEFAULT 'general',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(self._conn, name)
     
-    # Add status column to existing projects table if it doesn't exist
-    try:
-        conn.execute('ALTER TABLE projects ADD COLUMN status TEXT DEFAULT "live" CHECK(status IN ("live", "finished"))')
-        conn.commit()
-    except sqlite3.OperationalError:
-        # Column already exists, which is fine
-        pass
+    def close(self):
+        """Release the connection (or the caller's hold on the request connection)"""
+        if self._conn is None:
+            return
+        
+        if self._request_scoped:
+            self._depth = max(self._depth - 1, 0)
+            # Discard anything the last holder left uncommitted so it does not
+            # leak into the next service call of the same request
+            if self._depth == 0 and self._conn.in_transaction:
+                self._conn.rollback()
+            return
+        
+        self.release()
     
-    conn.commit()
+    def release(self):
+        """Hand the underlying connection back to the pool"""
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+
+def get_pool():
+    """Get the connection pool for the configured database"""
+    database_path = os.getenv('DATABASE', 'timesheet.db')
+    pool = _pools.get(database_path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(database_path)
+            if pool is None:
+                pool = _pools[database_path] = ConnectionPool(
+                    database_path,
+                    max_size=int(os.getenv('DB_POOL_SIZE', 5)),
+                    max_connections=int(os.getenv('DB_POOL_MAX_CONNECTIONS', 20)),
+                    timeout=float(os.getenv('DB_POOL_TIMEOUT', 30))
+                )
+    return pool
+
+
+def get_db_connection():
+    """Get database connection.
     
-    # Seed default projects if table is empty
-    seed_default_projects(conn)
+    Within a request the same pooled connection is returned for every call, so
+    a page view pays for one connection setup. Callers still close() it as
+    before; the connection goes back to the pool when the app context ends.
+    """
+    pool = get_pool()
     
-    # Seed default system settings if table is empty
-    seed_default_system_settings(conn)
+    if has_app_context():
+        handle = g.get('_db_connection')
+        if handle is None:
+            handle = PooledConnection(pool.acquire(), pool, request_scoped=True)
+            g._db_connection = handle
+        handle._depth += 1
+        return handle
     
-    conn.close()
+    return PooledConnection(pool.acquire(), pool)
 
 
-def seed_default_projects(conn):
-    """Seed default projects if the projects table is empty"""
-    count = conn.execute('SELECT COUNT(*) FROM projects').fetchone()[0]
+def get_data_versions(*names):
+    """Get the change counters for the given tables from data_versions.
     
-    if count == 0:
-        default_projects = [
-            ('PROJ001', 'Website Redesign'),
-            ('PROJ002', 'Mobile App Development'),
-            ('PROJ003', 'Database Migration'),
-            ('PROJ004', 'API Integration'),
-            ('PROJ005', 'Security Audit'),
-            ('PROJ006', 'Performance Testing'),
-            ('PROJ007', 'Documentation Update'),
-            ('PROJ008', 'Bug Fixes'),
-            ('PROJ009', 'User Training'),
-            ('PROJ010', 'Code Review')
-        ]
-        
-        conn.executemany('''
-            INSERT INTO projects (project_id, project_name, status)
-            VALUES (?, ?, 'live')
-        ''', default_projects)
-        
-        conn.commit()
-        print("Default projects seeded")
+    Every write to a tracked table bumps its counter (see migrations), so an
+    unchanged tuple means unchanged data. Unknown names report 0.
+    """
+    conn = get_db_connection()
+    try:
+        placeholders = ', '.join('?' for _ in names)
+        rows = conn.execute(f'''
+            SELECT name, version FROM data_versions WHERE name IN ({placeholders})
+        ''', names).fetchall()
+        versions = {row['name']: row['version'] for row in rows}
+        return tuple(versions.get(name, 0) for name in names)
+    finally:
+        conn.close()
 
 
-def seed_default_system_settings(conn):
-    """Seed default system settings if the system_settings table is empty"""
-    count = conn.execute('SELECT COUNT(*) FROM system_settings').fetchone()[0]
-    
-    if count == 0:
-        # Default system settings
-        default_settings = [
-            # Customization settings
-            ('custom_company_name', 'Guerrilla T', 'text', 0, 'Company name displayed in the application', 'customization'),
-            ('custom_logo_url', '', 'text', 0, 'URL or path to company logo', 'customization'),
-            ('custom_primary_color', '#007bff', 'color', 0, 'Primary brand color', 'customization'),
-            ('custom_secondary_color', '#6c757d', 'color', 0, 'Secondary brand color', 'customization'),
-            ('custom_success_color', '#28a745', 'color', 0, 'Success color', 'customization'),
-            ('custom_danger_color', '#dc3545', 'color', 0, 'Danger/error color', 'customization'),
-            ('custom_warning_color', '#ffc107', 'color', 0, 'Warning color', 'customization'),
-            ('custom_info_color', '#17a2b8', 'color', 0, 'Info color', 'customization'),
-            
-            # OAuth settings
-            ('oauth_allow_sso', 'false', 'checkbox', 0, 'Enable Microsoft OAuth single sign-on', 'oauth'),
-            ('oauth_disable_passwords', 'false', 'checkbox', 0, 'Disable password authentication (SSO only)', 'oauth'),
-            ('oauth_tenant_id', '', 'text', 0, 'Microsoft Azure tenant ID or domain', 'oauth'),
-            ('oauth_client_id', '', 'text', 0, 'Microsoft Azure application client ID', 'oauth'),
-            ('oauth_client_secret', '', 'password', 1, 'Microsoft Azure application client secret', 'oauth'),
-            ('oauth_redirect_uri', '', 'text', 0, 'OAuth redirect URI (leave blank for auto-detection)', 'oauth'),
-        ]
-        
-        conn.executemany('''
-            INSERT INTO system_settings (setting_key, setting_value, setting_type, is_encrypted, description, category)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', default_settings)
-        
-        conn.commit()
-        print("Default system settings seeded")
+def release_db_connection(exception=None):
+    """Return the request's connection to the pool (app teardown hook)"""
+    handle = g.pop('_db_connection', None)
+    if handle is not None:
+        handle.release()
 
 
-def create_admin_user():
-    """Create admin user if it doesn't exist"""
-    admin_email = os.getenv('ADMIN_EMAIL')
-    admin_password = os.getenv('ADMIN_PASSWORD')
+def checkpoint_wal(mode='PASSIVE'):
+    """Fold the write-ahead log back into the main database file"""
+    conn = get_pool().acquire()
+    try:
+        return conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+    finally:
+        get_pool().release(conn)
+
+
+def start_checkpoint_task(interval):
+    """Start the background WAL checkpoint thread (once per process)"""
+    global _checkpoint_thread
     
-    if not admin_email or not admin_password:
-        print("Warning: ADMIN_EMAIL and ADMIN_PASSWORD not set in .env file")
+    if interval <= 0 or (_checkpoint_thread and _checkpoint_thread.is_alive()):
         return
     
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                checkpoint_wal()
+            except sqlite3.Error as e:
+                print(f"WAL checkpoint error: {e}")
+    
+    _checkpoint_thread = threading.Thread(target=run, name='wal-checkpoint', daemon=True)
+    _checkpoint_thread.start()
+
+
+def rebuild_rollups():
+    """Recompute the rollup tables from scratch (recovery after manual edits)"""
+    from .migrations import rebuild_rollups as rebuild
+    
     conn = get_db_connection()
     try:
-        # Check if admin user exists
-        existing_admin = conn.execute('''
-            SELECT id FROM users WHERE email = ?
-        ''', (admin_email,)).fetchone()
-        
-        if not existing_admin:
-            hashed_password = hash_password(admin_password)
-            conn.execute('''
-                INSERT INTO users (email, password_hash, is_admin)
-                VALUES (?, ?, 1)
-            ''', (admin_email, hashed_password))
-            conn.commit()
-            print(f"Admin user created: {admin_email}")
+        rebuild(conn)
+        conn.commit()
     finally:
         conn.close()
 
 
-def ensure_oauth_settings_exist():
-    """Ensure OAuth settings exist in the database (for existing databases)"""
+def init_app(app):
+    """Register database lifecycle hooks with the Flask app"""
+    app.teardown_appcontext(release_db_connection)
+    
+    @app.cli.command('rebuild-rollups')
+    def rebuild_rollups_command():
+        """Recompute user, project and daily totals from the timesheet table."""
+        rebuild_rollups()
+        print("Rollup tables rebuilt")
+    
+    @app.cli.command('reaggregate-timesheet')
+    @click.argument('start_date')
+    @click.argument('end_date')
+    @click.option('--user-id', type=int, default=None, help='Only recompute this user.')
+    def reaggregate_timesheet_command(start_date, end_date, user_id):
+        """Recompute timesheet totals from the interval log for a date range."""
+        from ..services.timesheet_service import TimesheetService
+        
+        changed = TimesheetService.reaggregate(start_date, end_date, user_id)
+        print(f"Reaggregated {start_date} to {end_date}: {changed} timesheet row(s) changed")
+    
+    @app.cli.command('rotate-settings-key')
+    def rotate_settings_key_command():
+        """Re-encrypt stored secrets with the current SECRET_KEY."""
+        from ..services.system_settings_service import SystemSettingsService
+        
+        success, message = SystemSettingsService.rotate_encryption_key()
+        print(message)
+        if not success:
+            raise SystemExit(1)
+    
+    # Readers keep the WAL from being reset, so checkpoint periodically to stop
+    # it growing without bound under constant Power BI traffic
+    if os.getenv('DB_JOURNAL_MODE', 'WAL').upper() == 'WAL':
+        start_checkpoint_task(int(os.getenv('DB_CHECKPOINT_INTERVAL', 300)))
+
+
+def init_database():
+    """Bring the database schema up to date and ensure the admin user exists.
+    
+    With an already-migrated database this is a single version lookup (plus
+    the admin check when ADMIN_EMAIL is configured) on one connection.
+    """
+    from .migrations import apply_migrations
+    
     conn = get_db_connection()
     try:
-        # Check if OAuth settings exist
-        oauth_count = conn.execute('''
-            SELECT COUNT(*) FROM system_settings WHERE category = 'oauth'
-        ''').fetchone()[0]
-        
-        if oauth_count == 0:
-            print("OAuth settings not found, adding them...")
-            # OAuth settings to add
-            oauth_settings = [
-                ('oauth_allow_sso', 'false', 'checkbox', 0, 'Enable Microsoft OAuth single sign-on', 'oauth'),
-                ('oauth_disable_passwords', 'false', 'checkbox', 0, 'Disable password authentication (SSO only)', 'oauth'),
-                ('oauth_tenant_id', '', 'text', 0, 'Microsoft Azure tenant ID or domain', 'oauth'),
-                ('oauth_client_id', '', 'text', 0, 'Microsoft Azure application client ID', 'oauth'),
-                ('oauth_client_secret', '', 'password', 1, 'Microsoft Azure application client secret', 'oauth'),
-                ('oauth_redirect_uri', '', 'text', 0, 'OAuth redirect URI (leave blank for auto-detection)', 'oauth'),
-            ]
-            
-            conn.executemany('''
-                INSERT INTO system_settings (setting_key, setting_value, setting_type, is_encrypted, description, category)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', oauth_settings)
-            
-            conn.commit()
-            print("OAuth settings added to existing database")
+        apply_migrations(conn)
+        create_admin_user(conn)
     finally:
         conn.close()
+
+
+def create_admin_user(conn):
+    """Create admin user if it doesn't exist"""
+    admin_email = os.getenv('ADMIN_EMAIL')
+    admin_password = os.getenv('ADMIN_PASSWORD')
+    
+    if not admin_email or not admin_password:
+        print("Warning: ADMIN_EMAIL and ADMIN_PASSWORD not set in .env file")
+        return
+    
+    # Check if admin user exists
+    existing_admin = conn.execute('''
+        SELECT id FROM users WHERE email = ?
+    ''', (admin_email,)).fetchone()
+    
+    if not existing_admin:
+        hashed_password = hash_password(admin_password)
+        conn.execute('''
+            INSERT INTO users (email, password_hash, is_admin)
+            VALUES (?, ?, 1)
+        ''', (admin_email, hashed_password))
+        conn.commit()
+        print(f"Admin user created: {admin_email}")
@@ -0,0 +1,681 @@
+"""
+Versioned schema migrations for Timesheet Tracker
+
+Each migration is applied once, in order, and recorded in the schema_version
+table. Steps are written to be idempotent so databases created before
+versioning was introduced are adopted cleanly.
+"""
+
+import sqlite3
+
+
+def _column_names(conn, table):
+    """Get the column names of a table"""
+    return [column[1] for column in conn.execute(f'PRAGMA table_info({table})').fetchall()]
+
+
+def _create_base_tables(conn):
+    """Create users, timesheet, daily_projects, projects and system_settings"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            is_admin INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            temp_password TEXT NULL,
+            is_disabled INTEGER DEFAULT 0,
+            microsoft_id TEXT NULL,
+            display_name TEXT NULL,
+            auth_method TEXT DEFAULT 'password',
+            password_disabled INTEGER DEFAULT 0,
+            totp_secret TEXT NULL,
+            totp_enabled INTEGER DEFAULT 0,
+            backup_codes TEXT NULL
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS timesheet (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            project_id TEXT NOT NULL,
+            project_name TEXT NOT NULL,
+            total_minutes REAL DEFAULT 0,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(user_id, date, project_id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_projects (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            project_id TEXT NOT NULL,
+            project_name TEXT NOT NULL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(user_id, date, project_id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS projects (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            project_id TEXT UNIQUE NOT NULL,
+            project_name TEXT NOT NULL,
+            status TEXT DEFAULT 'live' CHECK(status IN ('live', 'finished')),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS system_settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            setting_key TEXT UNIQUE NOT NULL,
+            setting_value TEXT NULL,
+            setting_type TEXT DEFAULT 'text',
+            is_encrypted INTEGER DEFAULT 0,
+            description TEXT NULL,
+            category TEXT DEFAULT 'general',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _add_legacy_columns(conn):
+    """Add columns introduced after the first release to older databases"""
+    required_columns = {
+        'users': [
+            ('temp_password', 'TEXT NULL'),
+            ('is_disabled', 'INTEGER DEFAULT 0'),
+            ('microsoft_id', 'TEXT NULL'),
+            ('display_name', 'TEXT NULL'),
+            ('auth_method', 'TEXT DEFAULT "password"'),
+            ('password_disabled', 'INTEGER DEFAULT 0'),
+            ('totp_secret', 'TEXT NULL'),
+            ('totp_enabled', 'INTEGER DEFAULT 0'),
+            ('backup_codes', 'TEXT NULL')
+        ],
+        'projects': [
+            ('status', 'TEXT DEFAULT "live" CHECK(status IN ("live", "finished"))')
+        ]
+    }
+
+    for table, columns in required_columns.items():
+        existing_columns = _column_names(conn, table)
+        for column_name, column_def in columns:
+            if column_name not in existing_columns:
+                print(f"Adding column: {table}.{column_name}")
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column_name} {column_def}')
+
+
+def _seed_default_projects(conn):
+    """Seed default projects if the projects table is empty"""
+    count = conn.execute('SELECT COUNT(*) FROM projects').fetchone()[0]
+
+    if count == 0:
+        default_projects = [
+            ('PROJ001', 'Website Redesign'),
+            ('PROJ002', 'Mobile App Development'),
+            ('PROJ003', 'Database Migration'),
+            ('PROJ004', 'API Integration'),
+            ('PROJ005', 'Security Audit'),
+            ('PROJ006', 'Performance Testing'),
+            ('PROJ007', 'Documentation Update'),
+            ('PROJ008', 'Bug Fixes'),
+            ('PROJ009', 'User Training'),
+            ('PROJ010', 'Code Review')
+        ]
+
+        conn.executemany('''
+            INSERT INTO projects (project_id, project_name, status)
+            VALUES (?, ?, 'live')
+        ''', default_projects)
+        print("Default projects seeded")
+
+
+def _seed_default_system_settings(conn):
+    """Seed default customization and OAuth settings that are missing"""
+    default_settings = [
+        # Customization settings
+        ('custom_company_name', 'Guerrilla T', 'text', 0, 'Company name displayed in the application', 'customization'),
+        ('custom_logo_url', '', 'text', 0, 'URL or path to company logo', 'customization'),
+        ('custom_primary_color', '#007bff', 'color', 0, 'Primary brand color', 'customization'),
+        ('custom_secondary_color', '#6c757d', 'color', 0, 'Secondary brand color', 'customization'),
+        ('custom_success_color', '#28a745', 'color', 0, 'Success color', 'customization'),
+        ('custom_danger_color', '#dc3545', 'color', 0, 'Danger/error color', 'customization'),
+        ('custom_warning_color', '#ffc107', 'color', 0, 'Warning color', 'customization'),
+        ('custom_info_color', '#17a2b8', 'color', 0, 'Info color', 'customization'),
+
+        # OAuth settings
+        ('oauth_allow_sso', 'false', 'checkbox', 0, 'Enable Microsoft OAuth single sign-on', 'oauth'),
+        ('oauth_disable_passwords', 'false', 'checkbox', 0, 'Disable password authentication (SSO only)', 'oauth'),
+        ('oauth_tenant_id', '', 'text', 0, 'Microsoft Azure tenant ID or domain', 'oauth'),
+        ('oauth_client_id', '', 'text', 0, 'Microsoft Azure application client ID', 'oauth'),
+        ('oauth_client_secret', '', 'password', 1, 'Microsoft Azure application client secret', 'oauth'),
+        ('oauth_redirect_uri', '', 'text', 0, 'OAuth redirect URI (leave blank for auto-detection)', 'oauth'),
+    ]
+
+    # Customization defaults are only seeded into a brand-new settings table,
+    # OAuth settings are back-filled into older databases as well
+    count = conn.execute('SELECT COUNT(*) FROM system_settings').fetchone()[0]
+    if count > 0:
+        default_settings = [setting for setting in default_settings if setting[5] == 'oauth']
+
+    result = conn.executemany('''
+        INSERT OR IGNORE INTO system_settings (setting_key, setting_value, setting_type, is_encrypted, description, category)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', default_settings)
+
+    if result.rowcount > 0:
+        print("Default system settings seeded")
+
+
+def _create_secondary_indexes(conn):
+    """Index the columns the services join, filter and sort on.
+
+    UNIQUE(user_id, date, project_id) already serves per-user lookups; these
+    cover project-wide joins, date-range filters, change tracking and the
+    live/finished project lists.
+    """
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_timesheet_project_date ON timesheet (project_id, date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_timesheet_date ON timesheet (date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_timesheet_last_updated ON timesheet (last_updated)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_daily_projects_project ON daily_projects (project_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_projects_status ON projects (status, project_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)')
+    conn.execute('ANALYZE')
+
+
+def _rollup_add_sql(row):
+    """Statements that add a timesheet row (NEW) to every rollup table"""
+    return f'''
+        INSERT INTO user_totals (user_id, total_minutes, entry_count)
+        VALUES ({row}.user_id, COALESCE({row}.total_minutes, 0), 1)
+        ON CONFLICT(user_id) DO UPDATE SET
+            total_minutes = total_minutes + excluded.total_minutes,
+            entry_count = entry_count + 1;
+
+        INSERT INTO daily_totals (date, total_minutes, entry_count)
+        VALUES ({row}.date, COALESCE({row}.total_minutes, 0), 1)
+        ON CONFLICT(date) DO UPDATE SET
+            total_minutes = total_minutes + excluded.total_minutes,
+            entry_count = entry_count + 1;
+
+        INSERT INTO project_user_totals (project_id, user_id, total_minutes, entry_count)
+        VALUES ({row}.project_id, {row}.user_id, COALESCE({row}.total_minutes, 0), 1)
+        ON CONFLICT(project_id, user_id) DO UPDATE SET
+            total_minutes = total_minutes + excluded.total_minutes,
+            entry_count = entry_count + 1;
+
+        INSERT INTO project_totals (project_id, project_name, total_minutes, entry_count,
+                                    first_date, last_date, last_activity)
+        VALUES ({row}.project_id, {row}.project_name, COALESCE({row}.total_minutes, 0), 1,
+                {row}.date, {row}.date, {row}.last_updated)
+        ON CONFLICT(project_id) DO UPDATE SET
+            project_name = excluded.project_name,
+            total_minutes = total_minutes + excluded.total_minutes,
+            entry_count = entry_count + 1,
+            first_date = MIN(first_date, excluded.first_date),
+            last_date = MAX(last_date, excluded.last_date),
+            last_activity = MAX(COALESCE(last_activity, ''), excluded.last_activity);
+    '''
+
+
+def _rollup_remove_sql(row):
+    """Statements that subtract a timesheet row (OLD) from every rollup table"""
+    return f'''
+        UPDATE user_totals
+        SET total_minutes = total_minutes - COALESCE({row}.total_minutes, 0),
+            entry_count = entry_count - 1
+        WHERE user_id = {row}.user_id;
+        DELETE FROM user_totals WHERE user_id = {row}.user_id AND entry_count <= 0;
+
+        UPDATE daily_totals
+        SET total_minutes = total_minutes - COALESCE({row}.total_minutes, 0),
+            entry_count = entry_count - 1
+        WHERE date = {row}.date;
+        DELETE FROM daily_totals WHERE date = {row}.date AND entry_count <= 0;
+
+        UPDATE project_user_totals
+        SET total_minutes = total_minutes - COALESCE({row}.total_minutes, 0),
+            entry_count = entry_count - 1
+        WHERE project_id = {row}.project_id AND user_id = {row}.user_id;
+        DELETE FROM project_user_totals
+        WHERE project_id = {row}.project_id AND user_id = {row}.user_id AND entry_count <= 0;
+
+        -- Date and activity bounds can't be un-merged, so look them up again
+        -- through idx_timesheet_project_date and idx_timesheet_project_last_updated,
+        -- but only when the removed row sat on the bound
+        UPDATE project_totals
+        SET total_minutes = total_minutes - COALESCE({row}.total_minutes, 0),
+            entry_count = entry_count - 1,
+            first_date = CASE WHEN {row}.date <= first_date
+                THEN (SELECT MIN(date) FROM timesheet WHERE project_id = {row}.project_id)
+                ELSE first_date END,
+            last_date = CASE WHEN {row}.date >= last_date
+                THEN (SELECT MAX(date) FROM timesheet WHERE project_id = {row}.project_id)
+                ELSE last_date END,
+            last_activity = CASE WHEN COALESCE({row}.last_updated, '') >= COALESCE(last_activity, '')
+                THEN (SELECT MAX(last_updated) FROM timesheet WHERE project_id = {row}.project_id)
+                ELSE last_activity END
+        WHERE project_id = {row}.project_id;
+        DELETE FROM project_totals WHERE project_id = {row}.project_id AND entry_count <= 0;
+    '''
+
+
+def rebuild_rollups(conn):
+    """Recompute every rollup table from the timesheet table"""
+    conn.execute('DELETE FROM user_totals')
+    conn.execute('DELETE FROM daily_totals')
+    conn.execute('DELETE FROM project_user_totals')
+    conn.execute('DELETE FROM project_totals')
+
+    conn.execute('''
+        INSERT INTO user_totals (user_id, total_minutes, entry_count)
+        SELECT user_id, SUM(COALESCE(total_minutes, 0)), COUNT(*)
+        FROM timesheet
+        GROUP BY user_id
+    ''')
+    conn.execute('''
+        INSERT INTO daily_totals (date, total_minutes, entry_count)
+        SELECT date, SUM(COALESCE(total_minutes, 0)), COUNT(*)
+        FROM timesheet
+        GROUP BY date
+    ''')
+    conn.execute('''
+        INSERT INTO project_user_totals (project_id, user_id, total_minutes, entry_count)
+        SELECT project_id, user_id, SUM(COALESCE(total_minutes, 0)), COUNT(*)
+        FROM timesheet
+        GROUP BY project_id, user_id
+    ''')
+    conn.execute('''
+        INSERT INTO project_totals (project_id, project_name, total_minutes, entry_count,
+                                    first_date, last_date, last_activity)
+        SELECT project_id,
+               -- Same rule as the triggers: the most recently written row's name
+               (SELECT latest.project_name FROM timesheet latest
+                WHERE latest.project_id = timesheet.project_id
+                ORDER BY latest.last_updated DESC, latest.id DESC LIMIT 1),
+               SUM(COALESCE(total_minutes, 0)), COUNT(*),
+               MIN(date), MAX(date), MAX(last_updated)
+        FROM timesheet
+        GROUP BY project_id
+    ''')
+
+
+# A timesheet update that touches nothing the rollups count but the name
+_ROLLUP_RENAME_ONLY = '''
+    OLD.user_id IS NEW.user_id AND OLD.date IS NEW.date AND OLD.project_id IS NEW.project_id
+    AND OLD.total_minutes IS NEW.total_minutes AND OLD.last_updated IS NEW.last_updated
+'''
+
+
+def _create_rollup_triggers(conn):
+    """Create the triggers that keep the rollup tables in step with timesheet"""
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_timesheet_rollup_insert
+        AFTER INSERT ON timesheet
+        BEGIN
+            {_rollup_add_sql('NEW')}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_timesheet_rollup_update
+        AFTER UPDATE OF user_id, date, project_id, project_name, total_minutes, last_updated ON timesheet
+        WHEN NOT ({_ROLLUP_RENAME_ONLY})
+        BEGIN
+            {_rollup_remove_sql('OLD')}
+            {_rollup_add_sql('NEW')}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_timesheet_rollup_rename
+        AFTER UPDATE OF project_name ON timesheet
+        WHEN {_ROLLUP_RENAME_ONLY}
+        BEGIN
+            UPDATE project_totals SET project_name = NEW.project_name WHERE project_id = NEW.project_id;
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_timesheet_rollup_delete
+        AFTER DELETE ON timesheet
+        BEGIN
+            {_rollup_remove_sql('OLD')}
+        END
+    ''')
+
+
+def _create_rollup_tables(conn):
+    """Create per-user, per-project and per-day totals maintained by triggers"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_totals (
+            user_id INTEGER PRIMARY KEY,
+            total_minutes REAL NOT NULL DEFAULT 0,
+            entry_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_totals (
+            date TEXT PRIMARY KEY,
+            total_minutes REAL NOT NULL DEFAULT 0,
+            entry_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS project_user_totals (
+            project_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            total_minutes REAL NOT NULL DEFAULT 0,
+            entry_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (project_id, user_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS project_totals (
+            project_id TEXT PRIMARY KEY,
+            project_name TEXT NOT NULL,
+            total_minutes REAL NOT NULL DEFAULT 0,
+            entry_count INTEGER NOT NULL DEFAULT 0,
+            first_date TEXT NULL,
+            last_date TEXT NULL,
+            last_activity TIMESTAMP NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_project_totals_minutes ON project_totals (total_minutes, project_id)')
+
+    _create_rollup_triggers(conn)
+
+    rebuild_rollups(conn)
+
+
+def _create_change_tracking(conn):
+    """Stamp timesheet writes with a change sequence and keep delete tombstones.
+
+    data_versions holds one monotonically increasing counter per tracked
+    table; every insert, update or delete on timesheet bumps it. Rows carry
+    the counter value of their last change, deleted rows leave a tombstone.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS timesheet_tombstones (
+            change_seq INTEGER PRIMARY KEY,
+            timesheet_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            project_id TEXT NOT NULL,
+            deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    if 'change_seq' not in _column_names(conn, 'timesheet'):
+        conn.execute('ALTER TABLE timesheet ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0')
+
+    # Existing rows count as changed in id order
+    conn.execute('UPDATE timesheet SET change_seq = id')
+    conn.execute('''
+        INSERT OR IGNORE INTO data_versions (name, version)
+        SELECT 'timesheet', COALESCE(MAX(id), 0) FROM timesheet
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_timesheet_change_seq ON timesheet (change_seq)')
+
+    bump = "UPDATE data_versions SET version = version + 1 WHERE name = 'timesheet';"
+    current = "(SELECT version FROM data_versions WHERE name = 'timesheet')"
+
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_timesheet_change_insert
+        AFTER INSERT ON timesheet
+        BEGIN
+            {bump}
+            UPDATE timesheet SET change_seq = {current} WHERE id = NEW.id;
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_timesheet_change_update
+        AFTER UPDATE OF user_id, date, project_id, project_name, total_minutes, last_updated ON timesheet
+        BEGIN
+            {bump}
+            UPDATE timesheet SET change_seq = {current} WHERE id = NEW.id;
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_timesheet_change_delete
+        AFTER DELETE ON timesheet
+        BEGIN
+            {bump}
+            INSERT INTO timesheet_tombstones (change_seq, timesheet_id, user_id, date, project_id)
+            VALUES ({current}, OLD.id, OLD.user_id, OLD.date, OLD.project_id);
+        END
+    ''')
+
+
+def _create_version_counter(conn, table, name):
+    """Bump data_versions[name] on every insert, update or delete on table"""
+    conn.execute('INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)', (name,))
+
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()}
+            AFTER {event} ON {table}
+            BEGIN
+                UPDATE data_versions SET version = version + 1 WHERE name = '{name}';
+            END
+        ''')
+
+
+def _create_users_version(conn):
+    """Bump data_versions['users'] on every change to the users table"""
+    _create_version_counter(conn, 'users', 'users')
+
+
+def _create_active_tracking(conn):
+    """Store each user's running timer so every worker process sees it"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS active_tracking (
+            user_id INTEGER PRIMARY KEY,
+            project_id TEXT NOT NULL,
+            started_at TIMESTAMP NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+
+def _create_time_intervals(conn):
+    """Append-only interval log that timesheet totals are folded from.
+
+    kind is 'tracked' for timer intervals, 'edit' and 'delete' for manual
+    corrections (stored as minute deltas) and 'import' for totals that
+    predate the log.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS time_intervals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            project_id TEXT NOT NULL,
+            project_name TEXT NOT NULL,
+            started_at TIMESTAMP NULL,
+            ended_at TIMESTAMP NULL,
+            minutes REAL NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'tracked',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    # Existing totals become one interval each so that re-aggregation
+    # reproduces them; this must run before the fold trigger exists
+    conn.execute('''
+        INSERT INTO time_intervals (user_id, date, project_id, project_name, minutes, kind)
+        SELECT user_id, date, project_id, project_name, total_minutes, 'import'
+        FROM timesheet
+        ORDER BY id
+    ''')
+
+    # Covers range re-aggregation without touching the table
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_time_intervals_date
+        ON time_intervals (date, user_id, project_id, minutes)
+    ''')
+
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_time_intervals_fold
+        AFTER INSERT ON time_intervals
+        BEGIN
+            INSERT INTO timesheet (user_id, date, project_id, project_name, total_minutes)
+            VALUES (NEW.user_id, NEW.date, NEW.project_id, NEW.project_name, NEW.minutes)
+            ON CONFLICT (user_id, date, project_id) DO UPDATE SET
+                total_minutes = total_minutes + excluded.total_minutes,
+                last_updated = CURRENT_TIMESTAMP;
+        END
+    ''')
+
+
+def _create_settings_version(conn):
+    """Bump data_versions['system_settings'] on every change to system_settings"""
+    _create_version_counter(conn, 'system_settings', 'system_settings')
+
+
+def _create_export_jobs(conn):
+    """Background export jobs; finished files live in EXPORT_DIR"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS export_jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            file_path TEXT NULL,
+            filename TEXT NULL,
+            error TEXT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP NULL,
+            finished_at TIMESTAMP NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_export_jobs_created_at ON export_jobs (created_at)')
+
+
+def _index_tombstones_by_user(conn):
+    """Let a user's date range find its latest delete without a table scan"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_timesheet_tombstones_user_date ON timesheet_tombstones (user_id, date, change_seq)')
+
+
+def _index_project_activity(conn):
+    """Keep project rollup bounds cheap when a row is edited, renamed or deleted.
+
+    Recreates the rollup triggers so they only look a bound up again when the
+    removed row sat on it, and a rename no longer touches the bounds at all.
+    """
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_timesheet_project_last_updated ON timesheet (project_id, last_updated)')
+    for name in ('insert', 'update', 'rename', 'delete'):
+        conn.execute(f'DROP TRIGGER IF EXISTS trg_timesheet_rollup_{name}')
+    _create_rollup_triggers(conn)
+    rebuild_rollups(conn)
+
+
+def _index_time_intervals_by_project(conn):
+    """Let project renames and deletes find a project's intervals without a table scan"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_time_intervals_project ON time_intervals (project_id)')
+
+
+def _create_tracking_version(conn):
+    """Bump data_versions['tracking'] on every change to active_tracking"""
+    _create_version_counter(conn, 'active_tracking', 'tracking')
+
+
+def _index_export_jobs_by_state(conn):
+    """Index export jobs the way cleanup finds them: unfinished by age, finished by finish time"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_export_jobs_status ON export_jobs (status, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_export_jobs_finished_at ON export_jobs (finished_at)')
+    conn.execute('DROP INDEX IF EXISTS idx_export_jobs_created_at')
+
+
+# Ordered list of (version, description, step). Append new migrations to the
+# end; never renumber or edit a migration that has already shipped.
+MIGRATIONS = [
+    (1, 'Create base tables', _create_base_tables),
+    (2, 'Add user and project columns from earlier releases', _add_legacy_columns),
+    (3, 'Seed default projects', _seed_default_projects),
+    (4, 'Seed default system settings', _seed_default_system_settings),
+    (5, 'Create secondary indexes', _create_secondary_indexes),
+    (6, 'Create rollup tables and triggers', _create_rollup_tables),
+    (7, 'Add timesheet change sequence and tombstones', _create_change_tracking),
+    (8, 'Track users table version', _create_users_version),
+    (9, 'Create active tracking table', _create_active_tracking),
+    (10, 'Create time interval log', _create_time_intervals),
+    (11, 'Track system settings version', _create_settings_version),
+    (12, 'Create export jobs table', _create_export_jobs),
+    (13, 'Index timesheet tombstones by user and date', _index_tombstones_by_user),
+    (14, 'Index project activity and narrow rollup bound lookups', _index_project_activity),
+    (15, 'Index time intervals by project', _index_time_intervals_by_project),
+    (16, 'Track active tracking version', _create_tracking_version),
+    (17, 'Index export jobs by status and finish time', _index_export_jobs_by_state),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    """Get the version of the most recent applied migration (0 if none)"""
+    try:
+        row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    except sqlite3.OperationalError:
+        # schema_version table does not exist yet
+        return 0
+    return row[0] or 0
+
+
+def apply_migrations(conn):
+    """Apply every migration newer than the database's schema version.
+
+    Returns the list of versions that were applied.
+    """
+    if get_schema_version(conn) >= LATEST_VERSION:
+        return []
+
+    # Take the write lock before re-reading the version so that workers
+    # booting at the same time do not run the same step twice
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        current_version = get_schema_version(conn)
+
+        applied = []
+        for version, description, step in MIGRATIONS:
+            if version <= current_version:
+                continue
+
+            print(f"Applying migration {version}: {description}")
+            step(conn)
+            conn.execute('''
+                INSERT INTO schema_version (version, description)
+                VALUES (?, ?)
+            ''', (version, description))
+            applied.append(version)
+
+        conn.commit()
+        return applied
+    except Exception:
+        conn.rollback()
+        raise
@@ -3,8 +3,19 @@ User model and authentication utilities for Timesheet Tracker
 """
 
 from flask_login import LoginManager, UserMixin
+from collections import OrderedDict
 import bcrypt
 import os
+import threading
+import time
+
+# Loaded users are cached per process. An entry lives for USER_CACHE_TTL
+# seconds, and every USER_CACHE_VERSION_CHECK seconds the users counter in
+# data_versions is compared so changes made by other workers (such as
+# disabling an account) clear the cache promptly.
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 1024))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 60))
+USER_CACHE_VERSION_CHECK = float(os.getenv('USER_CACHE_VERSION_CHECK', 2))
 
 
 class User(UserMixin):
@@ -16,6 +27,73 @@ class User(UserMixin):
         self.totp_enabled = totp_enabled
 
 
+class UserCache:
+    """Bounded LRU cache of User objects keyed by id, with a per-entry TTL"""
+    
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked_at = 0.0
+    
+    def get(self, user_id):
+        """Get a cached user, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(str(user_id))
+            if entry is None:
+                return None
+            
+            user, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[str(user_id)]
+                return None
+            
+            self._entries.move_to_end(str(user_id))
+            return user
+    
+    def set(self, user_id, user):
+        """Cache a user, evicting the least recently used entries"""
+        if self.max_size <= 0:
+            return
+        
+        with self._lock:
+            self._entries[str(user_id)] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(str(user_id))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, user_id=None):
+        """Drop one user, or every user when no id is given"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(user_id), None)
+    
+    def sync_version(self, get_version):
+        """Clear the cache if the users table changed in any process"""
+        now = time.monotonic()
+        if now - self._version_checked_at < USER_CACHE_VERSION_CHECK:
+            return
+        
+        version = get_version()
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            self._version_checked_at = now
+
+
+_user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def invalidate_user_cache(user_id=None):
+    """Forget cached users after changing them (all users when no id is given)"""
+    _user_cache.invalidate(user_id)
+
+
 def hash_password(password):
     """Hash a password using bcrypt"""
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -35,22 +113,30 @@ def init_login_manager(app):
     
     @login_manager.user_loader
     def load_user(user_id):
-        """Load user from database for Flask-Login"""
-        from .database import get_db_connection
+        """Load user from the cache or database for Flask-Login"""
+        from .database import get_db_connection, get_data_versions
+        
+        _user_cache.sync_version(lambda: get_data_versions('users')[0])
+        cached = _user_cache.get(user_id)
+        if cached is not None:
+            return cached
         
         conn = get_db_connection()
         try:
             user = conn.execute('''
-                SELECT id, email, is_admin, totp_enabled FROM users WHERE id = ?
+                SELECT id, email, is_admin, totp_enabled, is_disabled FROM users WHERE id = ?
             ''', (user_id,)).fetchone()
             
-            if user:
-                return User(
+            # Disabled accounts lose their existing sessions too
+            if user and not user['is_disabled']:
+                loaded = User(
                     user['id'], 
                     user['email'], 
                     bool(user['is_admin']),
                     bool(user['totp_enabled'] if 'totp_enabled' in user.keys() else False)
                 )
+                _user_cache.set(user_id, loaded)
+                return loaded
             return None
         finally:
             conn.close()
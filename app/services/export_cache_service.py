@@ -0,0 +1,113 @@
+"""
+Export cache service for reusing generated export files
+"""
+
+import glob
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+# Where cached exports are kept and their total size limit in bytes (0 disables)
+EXPORT_CACHE_DIR = os.getenv('EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'timesheet-export-cache'))
+EXPORT_CACHE_SIZE = int(os.getenv('EXPORT_CACHE_SIZE', 256 * 1024 * 1024))
+
+_evict_lock = threading.Lock()
+
+
+class ExportCacheService:
+    """Service class for the disk-backed export file cache.
+    
+    Files are named u<user_id>_<start>_<end>_<version>.<format>, where version
+    is the data version of everything the file shows (the user's rows in that
+    range, plus the users table for formats that include the email), so a
+    stale file is never served. Every process shares the directory; files are evicted least
+    recently used first once the directory outgrows EXPORT_CACHE_SIZE.
+    """
+    
+    @staticmethod
+    def _path(user_id, start_date, end_date, file_format, version):
+        """Get the cache path for an export"""
+        return os.path.join(EXPORT_CACHE_DIR, f"u{user_id}_{start_date}_{end_date}_{version}.{file_format}")
+    
+    @staticmethod
+    def get(user_id, start_date, end_date, file_format, version):
+        """Get an open cached export, or None on a miss"""
+        if EXPORT_CACHE_SIZE <= 0:
+            return None
+        
+        path = ExportCacheService._path(user_id, start_date, end_date, file_format, version)
+        try:
+            output = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        
+        # The modification time doubles as the last-used time for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return output
+    
+    @staticmethod
+    def put(user_id, start_date, end_date, file_format, version, output):
+        """Store a copy of a generated export, leaving output rewound"""
+        if EXPORT_CACHE_SIZE <= 0:
+            return
+        
+        path = ExportCacheService._path(user_id, start_date, end_date, file_format, version)
+        part_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+            with open(part_path, 'wb') as f:
+                shutil.copyfileobj(output, f)
+            os.replace(part_path, path)
+        except OSError as e:
+            print(f"Error caching export: {e}")
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+        finally:
+            output.seek(0)
+        
+        ExportCacheService._evict()
+    
+    @staticmethod
+    def invalidate(user_id, date_str=None):
+        """Delete the user's cached exports covering date_str, or all of them"""
+        for path in glob.glob(os.path.join(EXPORT_CACHE_DIR, f"u{user_id}_*")):
+            if path.endswith('.part'):
+                continue
+            
+            start_date, end_date = os.path.basename(path).split('_')[1:3]
+            if date_str is None or start_date <= date_str <= end_date:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+    
+    @staticmethod
+    def _evict():
+        """Delete least recently used exports until the cache fits its size limit"""
+        with _evict_lock:
+            entries = []
+            for entry in os.scandir(EXPORT_CACHE_DIR):
+                if entry.name.endswith('.part'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total_size <= EXPORT_CACHE_SIZE:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
@@ -0,0 +1,226 @@
+"""
+Export job service for generating exports in the background
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from ..models.database import get_db_connection
+from .export_service import ExportService
+
+# Where finished exports are written, how long finished jobs and their files
+# are kept (seconds), how many exports run at once per process, and how long a
+# job may stay queued or running before it is presumed lost with its worker
+EXPORT_DIR = os.getenv('EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'timesheet-exports'))
+EXPORT_TTL = int(os.getenv('EXPORT_TTL', 3600))
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', 2))
+EXPORT_JOB_TIMEOUT = int(os.getenv('EXPORT_JOB_TIMEOUT', 900))
+
+_executor = None
+_executor_lock = threading.Lock()
+_cleanup_thread = None
+
+
+def _get_executor():
+    """Get the export thread pool, creating it on first use"""
+    global _executor
+    
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix='export')
+        return _executor
+
+
+class ExportJobService:
+    """Service class for background export jobs"""
+    
+    @staticmethod
+    def create_job(user_id, kind, params):
+        """Queue an export and return its job id"""
+        ExportJobService.cleanup_expired()
+        
+        job_id = uuid.uuid4().hex
+        conn = get_db_connection()
+        try:
+            conn.execute('''
+                INSERT INTO export_jobs (id, user_id, kind, params)
+                VALUES (?, ?, ?, ?)
+            ''', (job_id, user_id, kind, json.dumps(params)))
+            conn.commit()
+        finally:
+            conn.close()
+        
+        _get_executor().submit(ExportJobService._run_job, job_id)
+        return job_id
+    
+    @staticmethod
+    def get_job(job_id, user_id):
+        """Get a job as a dict if it belongs to the user, otherwise None"""
+        conn = get_db_connection()
+        try:
+            job = conn.execute('''
+                SELECT id, user_id, kind, params, status, file_path, filename, error,
+                       created_at, started_at, finished_at
+                FROM export_jobs
+                WHERE id = ? AND user_id = ?
+            ''', (job_id, user_id)).fetchone()
+            
+            if not job:
+                return None
+            
+            job = dict(job)
+            job['params'] = json.loads(job['params'])
+            return job
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def _build_export(kind, params):
+        """Generate the file for a job, returning (file object, filename)"""
+        start_date, end_date = params['start_date'], params['end_date']
+        
+        if kind == 'excel':
+            output = ExportService.generate_excel_export(start_date, end_date, params['user_id'])
+            return output, f"timesheet_{start_date}_to_{end_date}.xlsx"
+        
+        if kind == 'organisation':
+            group_by = params['group_by']
+            output = ExportService.generate_organisation_export(start_date, end_date, group_by)
+            return output, f"organisation_by_{group_by}_{start_date}_to_{end_date}.xlsx"
+        
+        if kind == 'records':
+            file_format, user_id = params['format'], params['user_id']
+            output = ExportService.generate_records_export(file_format, start_date, end_date, user_id)
+            extension = ExportService.EXPORTERS[file_format][0]
+            prefix = 'timesheet' if user_id is not None else 'organisation'
+            return output, f"{prefix}_{start_date}_to_{end_date}.{extension}"
+        
+        raise ValueError(f"Unknown export kind: {kind}")
+    
+    @staticmethod
+    def _set_status(job_id, status, from_status, **fields):
+        """Move a job from from_status to status, setting any of file_path,
+        filename or error. Returns False if the job had already left from_status.
+        """
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        timestamp = 'started_at' if status == 'running' else 'finished_at'
+        
+        conn = get_db_connection()
+        try:
+            cursor = conn.execute(f'''
+                UPDATE export_jobs
+                SET status = ?, {timestamp} = CURRENT_TIMESTAMP{', ' + assignments if fields else ''}
+                WHERE id = ? AND status = ?
+            ''', (status, *fields.values(), job_id, from_status))
+            conn.commit()
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def _run_job(job_id):
+        """Run one queued job on the export thread pool"""
+        conn = get_db_connection()
+        try:
+            job = conn.execute('''
+                SELECT kind, params FROM export_jobs WHERE id = ? AND status = 'queued'
+            ''', (job_id,)).fetchone()
+        finally:
+            conn.close()
+        
+        if not job or not ExportJobService._set_status(job_id, 'running', 'queued'):
+            return
+        
+        try:
+            output, filename = ExportJobService._build_export(job['kind'], json.loads(job['params']))
+            
+            # Write under a temporary name so a half-written file is never served
+            os.makedirs(EXPORT_DIR, exist_ok=True)
+            file_path = os.path.join(EXPORT_DIR, f"{job_id}{os.path.splitext(filename)[1]}")
+            with output, open(file_path + '.part', 'wb') as f:
+                shutil.copyfileobj(output, f)
+            os.replace(file_path + '.part', file_path)
+            
+            if not ExportJobService._set_status(job_id, 'done', 'running', file_path=file_path, filename=filename):
+                # Cleanup gave up on the job while it ran, so nothing will serve the file
+                os.remove(file_path)
+        except Exception as e:
+            print(f"Export job {job_id} failed: {e}")
+            ExportJobService._set_status(job_id, 'failed', 'running', error=str(e))
+    
+    @staticmethod
+    def cleanup_expired():
+        """Fail lost jobs and delete old finished ones.
+        
+        Jobs still queued or running after EXPORT_JOB_TIMEOUT are marked
+        failed; jobs finished more than EXPORT_TTL ago are deleted along with
+        their files. Returns the number of jobs deleted.
+        """
+        conn = get_db_connection()
+        try:
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute('BEGIN IMMEDIATE')
+            
+            # A worker that died (restart, OOM kill) leaves its jobs queued or
+            # running forever; the client would otherwise wait on them for good
+            conn.execute('''
+                UPDATE export_jobs
+                SET status = 'failed', error = 'Export did not finish in time', finished_at = CURRENT_TIMESTAMP
+                WHERE status IN ('queued', 'running')
+                  AND COALESCE(started_at, created_at) < datetime('now', ?)
+            ''', (f'-{EXPORT_JOB_TIMEOUT} seconds',))
+            
+            expired = conn.execute('''
+                SELECT id, file_path FROM export_jobs
+                WHERE finished_at < datetime('now', ?)
+            ''', (f'-{EXPORT_TTL} seconds',)).fetchall()
+            conn.executemany('DELETE FROM export_jobs WHERE id = ?', [(job['id'],) for job in expired])
+            conn.commit()
+        finally:
+            conn.close()
+        
+        for job in expired:
+            if job['file_path']:
+                try:
+                    os.remove(job['file_path'])
+                except FileNotFoundError:
+                    pass
+        
+        # A worker that died mid-write leaves its .part file behind. One still
+        # writing keeps touching its file, so only long-untouched ones go
+        cutoff = time.time() - EXPORT_JOB_TIMEOUT
+        for part_path in glob.glob(os.path.join(EXPORT_DIR, '*.part')):
+            try:
+                if os.path.getmtime(part_path) < cutoff:
+                    os.remove(part_path)
+            except FileNotFoundError:
+                pass
+        
+        return len(expired)
+
+
+def start_cleanup_task(interval):
+    """Start the background thread that expires export jobs (once per process)"""
+    global _cleanup_thread
+    
+    if interval <= 0 or (_cleanup_thread and _cleanup_thread.is_alive()):
+        return
+    
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                ExportJobService.cleanup_expired()
+            except (sqlite3.Error, OSError) as e:
+                print(f"Export cleanup error: {e}")
+    
+    _cleanup_thread = threading.Thread(target=run, name='export-cleanup', daemon=True)
+    _cleanup_thread.start()
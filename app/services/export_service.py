@@ -2,134 +2,369 @@
 Export service for generating Excel files and handling data exports
 """
 
+import csv
 from datetime import datetime, timedelta
+import io
+from itertools import groupby, islice, repeat
 from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
 from openpyxl.utils import get_column_letter
-import io
+import os
+import re
+import tempfile
 from .timesheet_service import TimesheetService
+from .export_cache_service import ExportCacheService
+from ..models.database import get_data_versions
+from ..utils.json_encoding import dumps
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Exports larger than this are spooled from memory to a temporary file
+EXPORT_SPOOL_SIZE = int(os.getenv('EXPORT_SPOOL_SIZE', 8 * 1024 * 1024))
+
+# Column widths are the longest value plus padding, capped like Excel's autofit
+MAX_COLUMN_WIDTH = 20
+
+# Excel limits sheet titles to 31 characters and forbids these characters
+MAX_SHEET_TITLE = 31
+INVALID_SHEET_TITLE_CHARS = re.compile(r'[\\/*?:\[\]]')
+
+# Columns of the flat (CSV, NDJSON, Parquet) exports: one row per user,
+# project and day with time tracked
+RECORD_COLUMNS = [
+    ('date', 'date'),
+    ('user_id', 'integer'),
+    ('email', 'string'),
+    ('project_id', 'string'),
+    ('project_name', 'string'),
+    ('minutes', 'float'),
+    ('hours', 'float')
+]
+
+# Rows per Parquet record batch; bounds memory while writing
+PARQUET_BATCH_SIZE = 10000
+
+
+def _create_named_styles(wb):
+    """Register the shared header and total styles on a workbook"""
+    thin = Side(style='thin')
+    wb.add_named_style(NamedStyle(
+        name='timesheet_header',
+        font=Font(bold=True, color='FFFFFF'),
+        fill=PatternFill(start_color='366092', end_color='366092', fill_type='solid'),
+        alignment=Alignment(horizontal='center', vertical='center'),
+        border=Border(left=thin, right=thin, top=thin, bottom=thin)
+    ))
+    wb.add_named_style(NamedStyle(
+        name='timesheet_total',
+        font=Font(bold=True),
+        fill=PatternFill(start_color='E6E6E6', end_color='E6E6E6', fill_type='solid'),
+        alignment=Alignment(horizontal='right')
+    ))
+
+
+def _styled_cell(ws, value, style):
+    """Create a write-only cell using one of the shared named styles"""
+    cell = WriteOnlyCell(ws, value=value)
+    cell.style = style
+    return cell
+
+
+def _sparse_matrix(row_count, column_count, cells):
+    """Lay out (row, column, value) cells as lists, leaving empty cells as None"""
+    matrix = [[None] * column_count for _ in range(row_count)]
+    for row, column, value in cells:
+        matrix[row][column] = value
+    return matrix
+
+
+def _date_range(start_date, end_date):
+    """Get every date from start_date to end_date inclusive as strings"""
+    start_dt = datetime.strptime(start_date, '%Y-%m-%d')
+    end_dt = datetime.strptime(end_date, '%Y-%m-%d')
+    
+    dates = []
+    current_date = start_dt
+    while current_date <= end_dt:
+        dates.append(current_date.strftime('%Y-%m-%d'))
+        current_date += timedelta(days=1)
+    return dates
+
+
+def _layout_sheet(headers, dates, cells, totals, total_label):
+    """Lay out one sheet from (row_id, row_name, date, minutes) cells ordered by row.
+    
+    Returns (rows, total_row, widths).
+    """
+    date_columns = {date: index for index, date in enumerate(dates)}
+    widths = [len(header) for header in headers]
+    
+    # Cells arrive ordered by row, so each new row id starts a row. Column
+    # widths are tracked as we go (write-only sheets need widths before any
+    # row), touching only cells where time was tracked
+    labels = []
+    placed = []
+    for row_id, row_name, date, minutes in cells:
+        if not labels or labels[-1][0] != row_id:
+            labels.append((row_id, row_name))
+            widths[0] = max(widths[0], len(str(row_id)))
+            widths[1] = max(widths[1], len(str(row_name)))
+        
+        column = date_columns.get(date)
+        if column is None or not minutes or minutes <= 0:
+            continue
+        
+        hours = round(minutes / 60, 2)
+        placed.append((len(labels) - 1, column, hours))
+        widths[column + 2] = max(widths[column + 2], len(str(hours)))
+    
+    if not labels:
+        return [], None, widths
+    
+    total_hours = [None] * len(dates)
+    for date, minutes in totals.items():
+        column = date_columns.get(date)
+        if column is not None:
+            total_hours[column] = round(minutes / 60, 2)
+    
+    widths[0] = max(widths[0], len('TOTAL'))
+    widths[1] = max(widths[1], len(total_label))
+    for column, hours in enumerate(total_hours):
+        if hours is not None:
+            widths[column + 2] = max(widths[column + 2], len(str(hours)))
+    
+    hours_matrix = _sparse_matrix(len(labels), len(dates), placed)
+    
+    rows = [[row_id, row_name] + hours for (row_id, row_name), hours in zip(labels, hours_matrix)]
+    return rows, ['TOTAL', total_label] + total_hours, widths
+
+
+def _write_sheet(wb, title, headers, rows, total_row, widths):
+    """Append a sheet with a styled header row and, if given, a totals row"""
+    ws = wb.create_sheet(title)
+    
+    for column, width in enumerate(widths, 1):
+        ws.column_dimensions[get_column_letter(column)].width = min(width + 2, MAX_COLUMN_WIDTH)
+    
+    ws.append([_styled_cell(ws, header, 'timesheet_header') for header in headers])
+    
+    # Days with no time are left empty
+    for row in rows:
+        ws.append(row)
+    
+    # The total labels stay unstyled; only the figures are highlighted
+    if total_row:
+        ws.append(total_row[:2] + [_styled_cell(ws, value, 'timesheet_total') for value in total_row[2:]])
+
+
+def _sheet_title(name, used):
+    """Make a valid, unique Excel sheet title from a user or project name"""
+    base = INVALID_SHEET_TITLE_CHARS.sub('_', str(name)).strip("' ") or 'Sheet'
+    title = base[:MAX_SHEET_TITLE]
+    suffix = 1
+    while title.lower() in used:
+        suffix += 1
+        tag = f" ({suffix})"
+        title = base[:MAX_SHEET_TITLE - len(tag)] + tag
+    used.add(title.lower())
+    return title
+
+
+def _save_workbook(wb):
+    """Save a workbook to a spooled file, rewound for reading"""
+    # Spool to a temporary file once the export outgrows memory
+    output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    wb.save(output)
+    output.seek(0)
+    return output
+
+
+def _iter_records(start_date, end_date, user_id):
+    """Yield flat export rows, adding hours to each timesheet row"""
+    for date, row_user_id, email, project_id, project_name, minutes in TimesheetService.iter_export_records(start_date, end_date, user_id):
+        yield (date, row_user_id, email, project_id, project_name, minutes, round(minutes / 60, 2))
 
 
 class ExportService:
     """Service class for export operations"""
     
+    # Flat export formats: name -> (file extension, mimetype, writer). A writer
+    # takes RECORD_COLUMNS, an iterator of row tuples and a binary file, and
+    # should write rows as it consumes them
+    EXPORTERS = {}
+    
     @staticmethod
-    def generate_excel_export(start_date, end_date, user_id):
-        """Generate Excel file with time tracking data"""
-        # Get the data
-        data = TimesheetService.get_export_data(start_date, end_date, user_id)
+    def register_exporter(name, extension, mimetype):
+        """Decorator registering a writer for a flat export format"""
+        def decorator(writer):
+            ExportService.EXPORTERS[name] = (extension, mimetype, writer)
+            return writer
+        return decorator
+    
+    @staticmethod
+    def get_formats():
+        """Get the names of all available export formats, Excel first"""
+        return ['xlsx'] + list(ExportService.EXPORTERS)
+    
+    @staticmethod
+    def generate_records_export(file_format, start_date, end_date, user_id=None):
+        """Generate a flat export of one user's time, or everyone's if user_id is None"""
+        extension, _, writer = ExportService.EXPORTERS[file_format]
         
-        # Create workbook and worksheet
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Timesheet"
+        # Only per-user exports have a data version to cache against. Rows
+        # carry the user's email, so a change to users must miss the cache too
+        if user_id is not None:
+            version = TimesheetService.get_export_version(start_date, end_date, user_id)
+            version = f"{version}-{get_data_versions('users')[0]}"
+            cached = ExportCacheService.get(user_id, start_date, end_date, extension, version)
+            if cached:
+                return cached
         
-        # Generate date range
-        start_dt = datetime.strptime(start_date, '%Y-%m-%d')
-        end_dt = datetime.strptime(end_date, '%Y-%m-%d')
+        output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+        writer(RECORD_COLUMNS, _iter_records(start_date, end_date, user_id), output)
+        output.seek(0)
+        
+        if user_id is not None:
+            ExportCacheService.put(user_id, start_date, end_date, extension, version, output)
+        return output
+    
+    @staticmethod
+    def generate_excel_export(start_date, end_date, user_id):
+        """Generate Excel file with time tracking data"""
+        # Read the version before the data, so a concurrent write can only
+        # make the cached file newer than its key, never older
+        version = TimesheetService.get_export_version(start_date, end_date, user_id)
+        cached = ExportCacheService.get(user_id, start_date, end_date, 'xlsx', version)
+        if cached:
+            return cached
         
-        dates = []
-        current_date = start_dt
-        while current_date <= end_dt:
-            dates.append(current_date.strftime('%Y-%m-%d'))
-            current_date += timedelta(days=1)
+        # Get the populated cells and per-date totals
+        cells, totals = TimesheetService.get_export_matrix(start_date, end_date, user_id)
         
-        # Create header row
+        dates = _date_range(start_date, end_date)
         headers = ['Project ID', 'Project Name'] + dates
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True, color='FFFFFF')
-            cell.fill = PatternFill(start_color='366092', end_color='366092', fill_type='solid')
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.border = Border(
-                left=Side(style='thin'),
-                right=Side(style='thin'),
-                top=Side(style='thin'),
-                bottom=Side(style='thin')
-            )
-        
-        # Organize data by project
-        project_data = {}
-        for row in data:
-            project_id = row['project_id']
-            project_name = row['project_name']
-            date = row['date']
-            minutes = row['total_minutes']
-            
-            if project_id not in project_data:
-                project_data[project_id] = {
-                    'name': project_name,
-                    'dates': {}
-                }
-            
-            project_data[project_id]['dates'][date] = minutes
-        
-        # Fill in the data
-        row_num = 2
-        for project_id in sorted(project_data.keys()):
-            project_info = project_data[project_id]
-            
-            # Project ID column
-            ws.cell(row=row_num, column=1, value=project_id)
-            
-            # Project Name column  
-            ws.cell(row=row_num, column=2, value=project_info['name'])
-            
-            # Time entries for each date
-            for col, date in enumerate(dates, 3):
-                minutes = project_info['dates'].get(date, 0)
-                # Convert to hours and only show if there's time tracked
-                if minutes > 0:
-                    hours = round(minutes / 60, 2)
-                    cell = ws.cell(row=row_num, column=col, value=hours)
-                    cell.alignment = Alignment(horizontal='right')
-                else:
-                    # Empty cell for days with no time
-                    ws.cell(row=row_num, column=col, value='')
-            
-            row_num += 1
-        
-        # Add totals row only if there's data
-        if project_data:
-            ws.cell(row=row_num, column=1, value='TOTAL')
-            ws.cell(row=row_num, column=2, value='All Projects')
-            
-            # Calculate totals for each date
-            for col, date in enumerate(dates, 3):
-                total_minutes = sum(
-                    project_info['dates'].get(date, 0) 
-                    for project_info in project_data.values()
-                )
-                if total_minutes > 0:
-                    total_hours = round(total_minutes / 60, 2)
-                    cell = ws.cell(row=row_num, column=col, value=total_hours)
-                    cell.font = Font(bold=True)
-                    cell.fill = PatternFill(start_color='E6E6E6', end_color='E6E6E6', fill_type='solid')
-                    cell.alignment = Alignment(horizontal='right')
-                else:
-                    # Empty cell for totals when no data
-                    cell = ws.cell(row=row_num, column=col, value='')
-                    cell.font = Font(bold=True)
-                    cell.fill = PatternFill(start_color='E6E6E6', end_color='E6E6E6', fill_type='solid')
-        
-        # Auto-adjust column widths
-        for column in ws.columns:
-            max_length = 0
-            column_letter = get_column_letter(column[0].column)
-            
-            for cell in column:
-                try:
-                    if cell.value and len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            
-            adjusted_width = min(max_length + 2, 20)
-            ws.column_dimensions[column_letter].width = adjusted_width
-        
-        # Save to memory
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
+        rows, total_row, widths = _layout_sheet(headers, dates, cells, totals, 'All Projects')
         
+        # Create write-only workbook and worksheet
+        wb = Workbook(write_only=True)
+        _create_named_styles(wb)
+        _write_sheet(wb, "Timesheet", headers, rows, total_row, widths)
+        
+        output = _save_workbook(wb)
+        ExportCacheService.put(user_id, start_date, end_date, 'xlsx', version, output)
         return output
+    
+    @staticmethod
+    def generate_organisation_export(start_date, end_date, group_by='user'):
+        """Generate Excel file with a summary sheet and one sheet per user or project.
+        
+        Sheets are laid out in a process pool and written into a single
+        workbook in order.
+        """
+        cells, total_rows = TimesheetService.get_organisation_export_matrix(start_date, end_date, group_by)
+        
+        totals = {}
+        for row in total_rows:
+            totals.setdefault(row['sheet_id'], {})[row['date']] = row['total_minutes']
+        
+        sheets = []
+        for (sheet_id, sheet_name), sheet_cells in groupby(cells, key=lambda row: (row['sheet_id'], row['sheet_name'])):
+            sheet_cells = [(row['row_id'], row['row_name'], row['date'], row['total_minutes']) for row in sheet_cells]
+            sheets.append((sheet_id, sheet_name, sheet_cells))
+        
+        if group_by == 'user':
+            summary_headers, summary_label = ['User ID', 'Email', 'Total Hours', 'Days Tracked'], 'All Users'
+            row_headers, total_label = ['Project ID', 'Project Name'], 'All Projects'
+        else:
+            summary_headers, summary_label = ['Project ID', 'Project Name', 'Total Hours', 'Days Tracked'], 'All Projects'
+            row_headers, total_label = ['User ID', 'Email'], 'All Users'
+        
+        dates = _date_range(start_date, end_date)
+        headers = row_headers + dates
+        
+        layout_args = (
+            repeat(headers),
+            repeat(dates),
+            [sheet_cells for _, _, sheet_cells in sheets],
+            [totals.get(sheet_id, {}) for sheet_id, _, _ in sheets],
+            repeat(total_label)
+        )
+        layouts = map(_layout_sheet, *layout_args)
+        
+        wb = Workbook(write_only=True)
+        _create_named_styles(wb)
+        
+        # Summary sheet: one row per sheet with its hours and days tracked
+        summary_rows = []
+        summary_widths = [len(header) for header in summary_headers]
+        all_minutes = 0
+        for sheet_id, sheet_name, _ in sheets:
+            sheet_totals = totals.get(sheet_id, {})
+            minutes = sum(sheet_totals.values())
+            all_minutes += minutes
+            row = [sheet_id, sheet_name, round(minutes / 60, 2), len(sheet_totals)]
+            summary_rows.append(row)
+            summary_widths = [max(width, len(str(value))) for width, value in zip(summary_widths, row)]
+        
+        summary_total = None
+        if summary_rows:
+            summary_total = ['TOTAL', summary_label, round(all_minutes / 60, 2), None]
+            summary_widths = [max(width, len(str(value))) for width, value in zip(summary_widths, summary_total[:3])] + summary_widths[3:]
+        
+        _write_sheet(wb, "Summary", summary_headers, summary_rows, summary_total, summary_widths)
+        
+        used_titles = {'summary'}
+        for (sheet_id, sheet_name, _), (rows, total_row, widths) in zip(sheets, layouts):
+            _write_sheet(wb, _sheet_title(sheet_name, used_titles), headers, rows, total_row, widths)
+        
+        return _save_workbook(wb)
+
+
+@ExportService.register_exporter('csv', 'csv', 'text/csv')
+def _write_csv(columns, rows, output):
+    """Write rows as CSV with a header line"""
+    text = io.TextIOWrapper(output, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow([name for name, _ in columns])
+    writer.writerows(rows)
+    
+    # Hand the binary file back to the caller open
+    text.flush()
+    text.detach()
+
+
+@ExportService.register_exporter('ndjson', 'ndjson', 'application/x-ndjson')
+def _write_ndjson(columns, rows, output):
+    """Write rows as newline-delimited JSON objects"""
+    names = [name for name, _ in columns]
+    for row in rows:
+        output.write(dumps(dict(zip(names, row))).encode('utf-8'))
+        output.write(b'\n')
+
+
+if pa is not None:
+    PARQUET_TYPES = {
+        'date': pa.date32(),
+        'integer': pa.int64(),
+        'string': pa.string(),
+        'float': pa.float64()
+    }
+    
+    @ExportService.register_exporter('parquet', 'parquet', 'application/vnd.apache.parquet')
+    def _write_parquet(columns, rows, output):
+        """Write rows as a Parquet file, one record batch at a time"""
+        schema = pa.schema([(name, PARQUET_TYPES[kind]) for name, kind in columns])
+        
+        with pq.ParquetWriter(output, schema) as writer:
+            while True:
+                batch = list(islice(rows, PARQUET_BATCH_SIZE))
+                if not batch:
+                    break
+                
+                arrays = [pa.array(values).cast(field.type) for values, field in zip(zip(*batch), schema)]
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
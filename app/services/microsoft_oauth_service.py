@@ -82,9 +82,7 @@ class MicrosoftOAuthService:
     def is_password_auth_disabled(self):
         """Check if password authentication is disabled (SSO only mode)"""
         try:
-            settings = self._get_oauth_settings()
-            
-            return settings and settings.get('oauth_disable_passwords') == 'true'
+            return self.settings_service.get_typed_setting('oauth_disable_passwords', False)
         except Exception as e:
             logger.error(f"Error checking password auth status: {e}")
             return False
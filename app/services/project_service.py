@@ -4,6 +4,11 @@ Project service for managing projects and daily selections
 
 from ..models.database import get_db_connection
 from datetime import datetime
+import csv
+
+# Project IDs looked up per query during a CSV import; stays under SQLite's
+# older 999 bound-parameter limit
+IMPORT_LOOKUP_BATCH = 500
 
 
 class ProjectService:
@@ -49,11 +54,10 @@ class ProjectService:
                         p.project_id,
                         p.project_name,
                         p.status,
-                        COALESCE(SUM(t.total_minutes), 0) as total_minutes,
-                        MAX(t.last_updated) as last_activity
+                        COALESCE(pt.total_minutes, 0) as total_minutes,
+                        pt.last_activity
                     FROM projects p
-                    LEFT JOIN timesheet t ON p.project_id = t.project_id
-                    GROUP BY p.project_id, p.project_name, p.status
+                    LEFT JOIN project_totals pt ON p.project_id = pt.project_id
                     ORDER BY p.status, p.project_id
                 '''
                 rows = conn.execute(query).fetchall()
@@ -63,12 +67,11 @@ class ProjectService:
                         p.project_id,
                         p.project_name,
                         p.status,
-                        COALESCE(SUM(t.total_minutes), 0) as total_minutes,
-                        MAX(t.last_updated) as last_activity
+                        COALESCE(pt.total_minutes, 0) as total_minutes,
+                        pt.last_activity
                     FROM projects p
-                    LEFT JOIN timesheet t ON p.project_id = t.project_id
+                    LEFT JOIN project_totals pt ON p.project_id = pt.project_id
                     WHERE p.status = ?
-                    GROUP BY p.project_id, p.project_name, p.status
                     ORDER BY p.project_id
                 '''
                 rows = conn.execute(query, (status_filter,)).fetchall()
@@ -108,6 +111,139 @@ class ProjectService:
         finally:
             conn.close()
     
+    @staticmethod
+    def import_projects_from_csv(stream):
+        """Create or update projects from a CSV text stream in one transaction.
+        
+        Columns are Project ID, Project Name and an optional Status (live or
+        finished); a header row is detected and skipped. Existing projects are
+        renamed, and given the new status if one is set, instead of being
+        rejected. Invalid rows are skipped and the rest are still imported.
+        
+        Returns (True, report) where report holds added_count, updated_count,
+        error_count and one "Row N: message" entry per skipped row, or
+        (False, message) if the import failed and nothing was written.
+        """
+        projects = []
+        first_rows = {}
+        errors = []
+        
+        # Validate while reading so the file is never held in memory twice
+        for row_num, row in enumerate(csv.reader(stream), start=1):
+            if row_num == 1 and row and row[0].strip().lower() in ['project_id', 'project id', 'id']:
+                continue
+            
+            if not any(cell.strip() for cell in row):
+                continue
+            
+            if len(row) < 2:
+                errors.append(f"Row {row_num}: Not enough columns (expected at least 2)")
+                continue
+            
+            project_id = row[0].strip().upper()
+            project_name = row[1].strip()
+            status = row[2].strip().lower() if len(row) > 2 and row[2].strip() else None
+            
+            if not project_id or not project_name:
+                errors.append(f"Row {row_num}: Missing project ID or name")
+                continue
+            
+            if status is not None and status not in ['live', 'finished']:
+                errors.append(f"Row {row_num}: Invalid status '{status}'. Must be 'live' or 'finished'")
+                continue
+            
+            if project_id in first_rows:
+                errors.append(f"Row {row_num}: Duplicate project ID '{project_id}' (first seen on row {first_rows[project_id]})")
+                continue
+            
+            first_rows[project_id] = row_num
+            projects.append({'project_id': project_id, 'project_name': project_name, 'status': status})
+        
+        report = {
+            'added_count': 0,
+            'updated_count': 0,
+            'error_count': len(errors),
+            'errors': errors
+        }
+        if not projects:
+            return True, report
+        
+        conn = get_db_connection()
+        
+        try:
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute('BEGIN IMMEDIATE')
+            
+            # Only the projects named in the file, found through the project_id index
+            project_ids = [project['project_id'] for project in projects]
+            existing = {}
+            for start in range(0, len(project_ids), IMPORT_LOOKUP_BATCH):
+                batch = project_ids[start:start + IMPORT_LOOKUP_BATCH]
+                placeholders = ', '.join('?' for _ in batch)
+                for row in conn.execute(f'''
+                    SELECT project_id, project_name, status FROM projects
+                    WHERE project_id IN ({placeholders})
+                ''', batch):
+                    existing[row['project_id']] = (row['project_name'], row['status'])
+            
+            # Unchanged projects are skipped by the WHERE clause, so they keep
+            # their updated_at and fire no triggers
+            conn.executemany('''
+                INSERT INTO projects (project_id, project_name, status)
+                VALUES (:project_id, :project_name, COALESCE(:status, 'live'))
+                ON CONFLICT (project_id) DO UPDATE SET
+                    project_name = excluded.project_name,
+                    status = COALESCE(:status, projects.status),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE projects.project_name != excluded.project_name
+                   OR projects.status != COALESCE(:status, projects.status)
+            ''', projects)
+            
+            renamed = []
+            for project in projects:
+                if project['project_id'] not in existing:
+                    report['added_count'] += 1
+                    continue
+                
+                old_name, old_status = existing[project['project_id']]
+                if old_name != project['project_name']:
+                    renamed.append((project['project_id'], project['project_name']))
+                if old_name != project['project_name'] or project['status'] not in (None, old_status):
+                    report['updated_count'] += 1
+            
+            # Carry renames into related tables with one statement per table
+            if renamed:
+                conn.execute('''
+                    CREATE TEMP TABLE IF NOT EXISTS project_renames (
+                        project_id TEXT PRIMARY KEY,
+                        project_name TEXT NOT NULL
+                    )
+                ''')
+                conn.execute('DELETE FROM temp.project_renames')
+                conn.executemany('INSERT INTO temp.project_renames (project_id, project_name) VALUES (?, ?)', renamed)
+                
+                # IN keeps each table on its project_id index; UPDATE ... FROM
+                # would walk the whole table and probe the renames instead
+                for table in ['daily_projects', 'timesheet', 'time_intervals']:
+                    conn.execute(f'''
+                        UPDATE {table}
+                        SET project_name = (
+                            SELECT r.project_name FROM temp.project_renames r
+                            WHERE r.project_id = {table}.project_id
+                        )
+                        WHERE project_id IN (SELECT project_id FROM temp.project_renames)
+                    ''')
+                
+                conn.execute('DELETE FROM temp.project_renames')
+            
+            conn.commit()
+            return True, report
+        except Exception as e:
+            return False, f"Error importing projects: {str(e)}"
+        finally:
+            conn.close()
+    
     @staticmethod
     def update_project(project_id, project_name):
         """Update an existing project"""
@@ -137,6 +273,12 @@ class ProjectService:
                 WHERE project_id = ?
             ''', (project_name, project_id))
             
+            conn.execute('''
+                UPDATE time_intervals 
+                SET project_name = ?
+                WHERE project_id = ?
+            ''', (project_name, project_id))
+            
             conn.commit()
             return True, "Project updated successfully"
         except Exception as e:
@@ -161,6 +303,7 @@ class ProjectService:
             
             # Delete from all related tables
             conn.execute('DELETE FROM daily_projects WHERE project_id = ?', (project_id,))
+            conn.execute('DELETE FROM time_intervals WHERE project_id = ?', (project_id,))
             conn.execute('DELETE FROM timesheet WHERE project_id = ?', (project_id,))
             conn.execute('DELETE FROM projects WHERE project_id = ?', (project_id,))
             
@@ -184,11 +327,11 @@ class ProjectService:
         try:
             stats = conn.execute('''
                 SELECT 
-                    COUNT(DISTINCT p.project_id) as total_projects,
-                    COALESCE(SUM(t.total_minutes), 0) as total_time_minutes,
-                    COUNT(DISTINCT CASE WHEN t.total_minutes > 0 THEN p.project_id END) as active_projects
+                    COUNT(*) as total_projects,
+                    COALESCE(SUM(pt.total_minutes), 0) as total_time_minutes,
+                    COUNT(CASE WHEN pt.total_minutes > 0 THEN 1 END) as active_projects
                 FROM projects p
-                LEFT JOIN timesheet t ON p.project_id = t.project_id
+                LEFT JOIN project_totals pt ON p.project_id = pt.project_id
             ''').fetchone()
             
             return {
@@ -2,14 +2,38 @@
 System settings service for managing application configuration
 """
 
-from ..models.database import get_db_connection
+from ..models.database import get_db_connection, get_data_versions
+from flask import g, has_request_context
 import base64
 import secrets
-from cryptography.fernet import Fernet
+from functools import lru_cache
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import os
 
+# Every system_settings row (decrypted) as of a data_versions counter value.
+# Replaced as a whole, so readers never see a half-built cache.
+_settings_cache = {'version': None, 'rows': [], 'by_key': {}}
+
+
+@lru_cache(maxsize=8)
+def _derive_key(secret_key):
+    """Derive a Fernet key from a SECRET_KEY (PBKDF2 runs once per secret per process)"""
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=b'timesheet-app-salt',  # Fixed salt for consistent key derivation
+        iterations=100000,
+    )
+    return base64.urlsafe_b64encode(kdf.derive(secret_key.encode()))
+
+
+@lru_cache(maxsize=8)
+def _build_fernet(keys):
+    """Build one MultiFernet that encrypts with the first key and decrypts with any"""
+    return MultiFernet([Fernet(key) for key in keys])
+
 
 class SystemSettingsService:
     """Service class for system settings management"""
@@ -17,6 +41,11 @@ class SystemSettingsService:
     @staticmethod
     def _get_encryption_key():
         """Get encryption key from Flask SECRET_KEY"""
+        return SystemSettingsService._get_encryption_keys()[0]
+    
+    @staticmethod
+    def _get_encryption_keys():
+        """Get the current encryption key followed by keys from SECRET_KEY_FALLBACKS"""
         from flask import current_app
         
         try:
@@ -25,15 +54,8 @@ class SystemSettingsService:
             if not secret_key:
                 raise ValueError("SECRET_KEY not configured in Flask app")
             
-            # Derive a Fernet key from the SECRET_KEY using PBKDF2
-            kdf = PBKDF2HMAC(
-                algorithm=hashes.SHA256(),
-                length=32,
-                salt=b'timesheet-app-salt',  # Fixed salt for consistent key derivation
-                iterations=100000,
-            )
-            key = base64.urlsafe_b64encode(kdf.derive(secret_key.encode()))
-            return key
+            fallbacks = current_app.config.get('SECRET_KEY_FALLBACKS') or []
+            return [_derive_key(key) for key in [secret_key, *fallbacks]]
             
         except Exception as e:
             # Fallback to file-based key if Flask context is not available
@@ -42,14 +64,19 @@ class SystemSettingsService:
             
             if os.path.exists(key_file):
                 with open(key_file, 'rb') as f:
-                    return f.read()
+                    return [f.read()]
             else:
                 # Generate new key
                 key = Fernet.generate_key()
                 os.makedirs(os.path.dirname(key_file), exist_ok=True)
                 with open(key_file, 'wb') as f:
                     f.write(key)
-                return key
+                return [key]
+    
+    @staticmethod
+    def _get_fernet():
+        """Get the shared MultiFernet for the configured keys"""
+        return _build_fernet(tuple(SystemSettingsService._get_encryption_keys()))
     
     @staticmethod
     def _encrypt_value(value):
@@ -58,8 +85,7 @@ class SystemSettingsService:
             return value
         
         try:
-            key = SystemSettingsService._get_encryption_key()
-            f = Fernet(key)
+            f = SystemSettingsService._get_fernet()
             encrypted_value = f.encrypt(value.encode())
             return base64.b64encode(encrypted_value).decode()
         except Exception as e:
@@ -73,8 +99,7 @@ class SystemSettingsService:
             return encrypted_value
         
         try:
-            key = SystemSettingsService._get_encryption_key()
-            f = Fernet(key)
+            f = SystemSettingsService._get_fernet()
             decoded_value = base64.b64decode(encrypted_value.encode())
             decrypted_value = f.decrypt(decoded_value)
             return decrypted_value.decode()
@@ -83,58 +108,142 @@ class SystemSettingsService:
             return encrypted_value
     
     @staticmethod
-    def get_all_settings():
-        """Get all system settings grouped by category"""
+    def rotate_encryption_key():
+        """Re-encrypt every encrypted setting with the current SECRET_KEY.
+        
+        Values written under a key listed in SECRET_KEY_FALLBACKS are
+        decrypted with it and encrypted again with the current key.
+        """
         conn = get_db_connection()
         try:
+            f = SystemSettingsService._get_fernet()
             settings = conn.execute('''
-                SELECT setting_key, setting_value, setting_type, is_encrypted, 
-                       description, category
-                FROM system_settings
-                ORDER BY category, setting_key
+                SELECT setting_key, setting_value FROM system_settings
+                WHERE is_encrypted = 1 AND setting_value IS NOT NULL AND setting_value != ''
             ''').fetchall()
             
-            grouped_settings = {}
+            updates = []
+            skipped = []
             for setting in settings:
-                setting_dict = dict(setting)
-                
-                # Decrypt if necessary
-                if setting_dict['is_encrypted'] and setting_dict['setting_value']:
-                    setting_dict['setting_value'] = SystemSettingsService._decrypt_value(
-                        setting_dict['setting_value']
-                    )
-                
-                category = setting_dict['category']
-                if category not in grouped_settings:
-                    grouped_settings[category] = []
-                
-                grouped_settings[category].append(setting_dict)
+                try:
+                    token = base64.b64decode(setting['setting_value'].encode())
+                    rotated = base64.b64encode(f.rotate(token)).decode()
+                    updates.append((rotated, setting['setting_key']))
+                except (InvalidToken, ValueError):
+                    skipped.append(setting['setting_key'])
+            
+            conn.executemany('''
+                UPDATE system_settings SET setting_value = ? WHERE setting_key = ?
+            ''', updates)
+            conn.commit()
+            SystemSettingsService.invalidate_cache()
             
-            return grouped_settings
+            message = f"Re-encrypted {len(updates)} setting(s)"
+            if skipped:
+                message += f"; could not decrypt {', '.join(skipped)}"
+            return not skipped, message
+        
+        except Exception as e:
+            return False, f"Error rotating encryption key: {str(e)}"
         finally:
             conn.close()
     
     @staticmethod
-    def get_setting(key):
-        """Get a specific setting value"""
+    def get_settings_version():
+        """Get the system_settings version, read at most once per request"""
+        if has_request_context():
+            if 'settings_version' not in g:
+                g.settings_version = get_data_versions('system_settings')[0]
+            return g.settings_version
+        return get_data_versions('system_settings')[0]
+    
+    @staticmethod
+    def _get_cached_settings():
+        """Get every setting from the in-process cache, reloading it if stale"""
+        global _settings_cache
+        
+        # Read the version before the rows: a write in between only makes the
+        # cache look older than it is, so it is reloaded on the next check
+        version = SystemSettingsService.get_settings_version()
+        cache = _settings_cache
+        if cache['version'] == version:
+            return cache
+        
         conn = get_db_connection()
         try:
-            setting = conn.execute('''
-                SELECT setting_value, is_encrypted
+            settings = conn.execute('''
+                SELECT setting_key, setting_value, setting_type, is_encrypted, 
+                       description, category
                 FROM system_settings
-                WHERE setting_key = ?
-            ''', (key,)).fetchone()
-            
-            if not setting:
-                return None
-            
-            value = setting['setting_value']
-            if setting['is_encrypted'] and value:
-                value = SystemSettingsService._decrypt_value(value)
-            
-            return value
+                ORDER BY category, setting_key
+            ''').fetchall()
         finally:
             conn.close()
+        
+        rows = []
+        for setting in settings:
+            setting_dict = dict(setting)
+            
+            # Decrypt if necessary
+            if setting_dict['is_encrypted'] and setting_dict['setting_value']:
+                setting_dict['setting_value'] = SystemSettingsService._decrypt_value(
+                    setting_dict['setting_value']
+                )
+            rows.append(setting_dict)
+        
+        cache = {
+            'version': version,
+            'rows': rows,
+            'by_key': {row['setting_key']: row for row in rows}
+        }
+        _settings_cache = cache
+        return cache
+    
+    @staticmethod
+    def invalidate_cache():
+        """Drop cached settings after writing them"""
+        global _settings_cache
+        
+        _settings_cache = {'version': None, 'rows': [], 'by_key': {}}
+        if has_request_context():
+            g.pop('settings_version', None)
+    
+    @staticmethod
+    def get_all_settings():
+        """Get all system settings grouped by category"""
+        grouped_settings = {}
+        for setting in SystemSettingsService._get_cached_settings()['rows']:
+            category = setting['category']
+            if category not in grouped_settings:
+                grouped_settings[category] = []
+            
+            grouped_settings[category].append(dict(setting))
+        
+        return grouped_settings
+    
+    @staticmethod
+    def get_setting(key):
+        """Get a specific setting value"""
+        setting = SystemSettingsService._get_cached_settings()['by_key'].get(key)
+        if not setting:
+            return None
+        
+        return setting['setting_value']
+    
+    @staticmethod
+    def get_typed_setting(key, default=None):
+        """Get a setting converted according to its setting_type.
+        
+        Checkbox settings are returned as booleans; missing or empty settings
+        return default.
+        """
+        setting = SystemSettingsService._get_cached_settings()['by_key'].get(key)
+        if not setting or setting['setting_value'] in (None, ''):
+            return default
+        
+        if setting['setting_type'] == 'checkbox':
+            return setting['setting_value'] == 'true'
+        return setting['setting_value']
     
     @staticmethod
     def update_setting(key, value):
@@ -163,6 +272,7 @@ class SystemSettingsService:
             ''', (final_value, key))
             
             conn.commit()
+            SystemSettingsService.invalidate_cache()
             return True, "Setting updated successfully"
         
         except Exception as e:
@@ -196,6 +306,7 @@ class SystemSettingsService:
                     ''', (final_value, key))
             
             conn.commit()
+            SystemSettingsService.invalidate_cache()
             return True, "Settings updated successfully"
         
         except Exception as e:
@@ -206,30 +317,14 @@ class SystemSettingsService:
     @staticmethod
     def get_settings_by_category(category):
         """Get all settings for a specific category"""
-        conn = get_db_connection()
-        try:
-            settings = conn.execute('''
-                SELECT setting_key, setting_value, setting_type, is_encrypted, description
-                FROM system_settings
-                WHERE category = ?
-                ORDER BY setting_key
-            ''', (category,)).fetchall()
-            
-            result = []
-            for setting in settings:
+        result = []
+        for setting in SystemSettingsService._get_cached_settings()['rows']:
+            if setting['category'] == category:
                 setting_dict = dict(setting)
-                
-                # Decrypt if necessary
-                if setting_dict['is_encrypted'] and setting_dict['setting_value']:
-                    setting_dict['setting_value'] = SystemSettingsService._decrypt_value(
-                        setting_dict['setting_value']
-                    )
-                
+                del setting_dict['category']
                 result.append(setting_dict)
-            
-            return result
-        finally:
-            conn.close()
+        
+        return result
     
     @staticmethod
     def reset_to_defaults():
@@ -238,6 +333,7 @@ class SystemSettingsService:
         try:
             # This would restore default values - implement based on needs
             # For now, just return success
+            SystemSettingsService.invalidate_cache()
             return True, "Settings reset to defaults"
         except Exception as e:
             return False, f"Error resetting settings: {str(e)}"
@@ -247,37 +343,23 @@ class SystemSettingsService:
     @staticmethod
     def get_customization_settings():
         """Get customization settings in a structured format for admin panel"""
-        conn = get_db_connection()
-        try:
-            settings = conn.execute('''
-                SELECT setting_key, setting_value, setting_type, is_encrypted, description
-                FROM system_settings
-                WHERE category = 'customization'
-                ORDER BY setting_key
-            ''').fetchall()
-            
-            # Create a simple object-like structure for template access
-            class CustomizationSettings:
-                def __init__(self):
-                    pass
-            
-            result = CustomizationSettings()
-            
-            for setting in settings:
-                setting_dict = dict(setting)
-                key = setting_dict['setting_key']
-                value = setting_dict['setting_value']
-                
-                # Decrypt if necessary
-                if setting_dict['is_encrypted'] and value:
-                    value = SystemSettingsService._decrypt_value(value)
-                
-                # Set attribute on result object (remove 'custom_' prefix for cleaner access)
-                attr_name = key.replace('custom_', '') if key.startswith('custom_') else key
-                setattr(result, attr_name, value)
-                # Also keep the full key for backward compatibility
-                setattr(result, key, value)
+        settings = SystemSettingsService.get_settings_by_category('customization')
+        
+        # Create a simple object-like structure for template access
+        class CustomizationSettings:
+            def __init__(self):
+                pass
+        
+        result = CustomizationSettings()
+        
+        for setting in settings:
+            key = setting['setting_key']
+            value = setting['setting_value']
             
-            return result
-        finally:
-            conn.close()
+            # Set attribute on result object (remove 'custom_' prefix for cleaner access)
+            attr_name = key.replace('custom_', '') if key.startswith('custom_') else key
+            setattr(result, attr_name, value)
+            # Also keep the full key for backward compatibility
+            setattr(result, key, value)
+        
+        return result
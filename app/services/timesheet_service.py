@@ -2,39 +2,137 @@
 Timesheet service for managing time tracking data
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
+import sqlite3
+import threading
+import time
 from ..models.database import get_db_connection
+from .export_cache_service import ExportCacheService
+
+_auto_stop_thread = None
 
 
 class TimesheetService:
     """Service class for timesheet operations"""
     
     @staticmethod
-    def log_time_entry(project_id, project_name, start_time, end_time, date_str, user_id):
-        """Log or update time entry to database"""
+    def _append_interval(conn, user_id, date_str, project_id, project_name, minutes,
+                         started_at=None, ended_at=None, kind='tracked'):
+        """Append an interval without committing.
+        
+        The trg_time_intervals_fold trigger adds the minutes to the matching
+        timesheet row, so this single insert is the whole write path.
+        """
+        conn.execute('''
+            INSERT INTO time_intervals
+                (user_id, date, project_id, project_name, started_at, ended_at, minutes, kind)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            user_id, date_str, project_id, project_name,
+            started_at.isoformat(sep=' ') if started_at else None,
+            ended_at.isoformat(sep=' ') if ended_at else None,
+            minutes, kind
+        ))
+    
+    @staticmethod
+    def get_active_tracking(user_id):
+        """Get the user's running timer as a dict, or None if nothing is tracked"""
         conn = get_db_connection()
         
-        duration = (end_time - start_time).total_seconds() / 60  # Duration in minutes
+        try:
+            row = conn.execute('''
+                SELECT project_id, started_at
+                FROM active_tracking
+                WHERE user_id = ?
+            ''', (user_id,)).fetchone()
+            
+            if not row:
+                return None
+            
+            return {
+                'project_id': row['project_id'],
+                'started_at': datetime.fromisoformat(row['started_at'])
+            }
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def _finish_active_tracking(conn, user_id, end_time, date_str=None):
+        """Log and clear the user's running timer inside the caller's transaction"""
+        row = conn.execute('''
+            SELECT project_id, started_at
+            FROM active_tracking
+            WHERE user_id = ?
+        ''', (user_id,)).fetchone()
+        
+        if not row:
+            return None
+        
+        project = conn.execute('''
+            SELECT project_name FROM projects WHERE project_id = ?
+        ''', (row['project_id'],)).fetchone()
+        project_name = project['project_name'] if project else 'Unknown'
+        
+        started_at = datetime.fromisoformat(row['started_at'])
+        duration = (end_time - started_at).total_seconds() / 60
+        TimesheetService._append_interval(
+            conn, user_id, date_str or end_time.strftime('%Y-%m-%d'),
+            row['project_id'], project_name, duration, started_at, end_time
+        )
+        conn.execute('DELETE FROM active_tracking WHERE user_id = ?', (user_id,))
+        
+        return row['project_id']
+    
+    @staticmethod
+    def start_active_tracking(user_id, project_id):
+        """Start the user's timer on a project, logging any timer already running.
+        
+        Returns the previously tracked project id, or None.
+        """
+        conn = get_db_connection()
+        now = datetime.now()
         
         try:
-            # Try to update existing entry
-            result = conn.execute('''
-                UPDATE timesheet 
-                SET total_minutes = total_minutes + ?, 
-                    last_updated = CURRENT_TIMESTAMP 
-                WHERE user_id = ? AND date = ? AND project_id = ?
-            ''', (duration, user_id, date_str, project_id))
-            
-            # If no rows were updated, insert new entry
-            if result.rowcount == 0:
-                conn.execute('''
-                    INSERT INTO timesheet (user_id, date, project_id, project_name, total_minutes)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, date_str, project_id, project_name, duration))
+            # Hold the write lock so concurrent requests from the same user
+            # (possibly in other workers) cannot both log the old timer
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute('BEGIN IMMEDIATE')
+            
+            previous_project = TimesheetService._finish_active_tracking(conn, user_id, now)
+            conn.execute('''
+                INSERT INTO active_tracking (user_id, project_id, started_at)
+                VALUES (?, ?, ?)
+            ''', (user_id, project_id, now.isoformat(sep=' ')))
+            
+            conn.commit()
+        finally:
+            conn.close()
+        
+        if previous_project:
+            ExportCacheService.invalidate(user_id, now.strftime('%Y-%m-%d'))
+        return previous_project
+    
+    @staticmethod
+    def stop_active_tracking(user_id):
+        """Stop and log the user's timer. Returns the tracked project id, or None"""
+        conn = get_db_connection()
+        
+        try:
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute('BEGIN IMMEDIATE')
+            
+            now = datetime.now()
+            tracked_project = TimesheetService._finish_active_tracking(conn, user_id, now)
             
             conn.commit()
         finally:
             conn.close()
+        
+        if tracked_project:
+            ExportCacheService.invalidate(user_id, now.strftime('%Y-%m-%d'))
+        return tracked_project
     
     @staticmethod
     def get_daily_aggregate(date_str, user_id):
@@ -93,25 +191,32 @@ class TimesheetService:
         conn = get_db_connection()
         
         try:
+            # Read the total under the write lock: the correction is a delta,
+            # so two concurrent edits must not both apply to the same total
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute('BEGIN IMMEDIATE')
+            
             # Get all entries for the date to find the correct one by index
             rows = conn.execute('''
-                SELECT id, project_id
+                SELECT id, project_id, project_name, total_minutes
                 FROM timesheet
                 WHERE user_id = ? AND date = ?
                 ORDER BY project_id
             ''', (user_id, date_str)).fetchall()
             
             if entry_id < len(rows):
-                db_id = rows[entry_id]['id']
+                row = rows[entry_id]
                 
-                # Update the entry
-                conn.execute('''
-                    UPDATE timesheet
-                    SET total_minutes = ?, last_updated = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (new_duration, db_id))
+                # Record the correction as a delta so the interval log still
+                # sums to the edited total
+                TimesheetService._append_interval(
+                    conn, user_id, date_str, row['project_id'], row['project_name'],
+                    new_duration - row['total_minutes'], kind='edit'
+                )
                 
                 conn.commit()
+                ExportCacheService.invalidate(user_id, date_str)
                 return True
             return False
         finally:
@@ -123,42 +228,285 @@ class TimesheetService:
         conn = get_db_connection()
         
         try:
+            # Read the total under the write lock, as update_entry does
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute('BEGIN IMMEDIATE')
+            
             # Get all entries for the date to find the correct one by index
             rows = conn.execute('''
-                SELECT id, project_id
+                SELECT id, project_id, project_name, total_minutes
                 FROM timesheet
                 WHERE user_id = ? AND date = ?
                 ORDER BY project_id
             ''', (user_id, date_str)).fetchall()
             
             if entry_id < len(rows):
-                db_id = rows[entry_id]['id']
+                row = rows[entry_id]
+                
+                # Cancel the logged time in the interval log, then drop the row
+                TimesheetService._append_interval(
+                    conn, user_id, date_str, row['project_id'], row['project_name'],
+                    -row['total_minutes'], kind='delete'
+                )
                 
                 # Delete the entry
                 conn.execute('''
                     DELETE FROM timesheet
                     WHERE id = ?
-                ''', (db_id,))
+                ''', (row['id'],))
                 
                 conn.commit()
+                ExportCacheService.invalidate(user_id, date_str)
                 return True
             return False
         finally:
             conn.close()
     
     @staticmethod
-    def get_export_data(start_date, end_date, user_id):
-        """Get time tracking data for export between date range"""
+    def get_export_version(start_date, end_date, user_id):
+        """Get the data version of a user's rows in a date range.
+        
+        This is the change_seq of the latest insert, update or delete among
+        them, so it moves whenever anything an export of the range shows does.
+        """
+        conn = get_db_connection()
+        
+        try:
+            row = conn.execute('''
+                SELECT MAX(
+                    (SELECT COALESCE(MAX(change_seq), 0) FROM timesheet
+                     WHERE user_id = ? AND date BETWEEN ? AND ?),
+                    (SELECT COALESCE(MAX(change_seq), 0) FROM timesheet_tombstones
+                     WHERE user_id = ? AND date BETWEEN ? AND ?)
+                ) AS version
+            ''', (user_id, start_date, end_date) * 2).fetchone()
+            
+            return row['version']
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def get_export_matrix(start_date, end_date, user_id):
+        """Get the project x date cells and per-date totals for an export.
+        
+        Returns (cells, totals): cells are (project_id, project_name, date,
+        total_minutes) rows ordered by project then date, and totals maps each
+        date with tracked time to its minutes. Both come from a single query;
+        the totals are the rows with a NULL project_id.
+        """
         conn = get_db_connection()
         
         try:
             rows = conn.execute('''
-                SELECT date, project_id, project_name, total_minutes
+                SELECT project_id, project_name, date, total_minutes
                 FROM timesheet
                 WHERE user_id = ? AND date BETWEEN ? AND ?
+                UNION ALL
+                SELECT NULL, NULL, date, SUM(total_minutes)
+                FROM timesheet
+                WHERE user_id = ? AND date BETWEEN ? AND ? AND total_minutes > 0
+                GROUP BY date
                 ORDER BY project_id, date
-            ''', (user_id, start_date, end_date)).fetchall()
+            ''', (user_id, start_date, end_date) * 2).fetchall()
+            
+            # NULLs sort first, so the totals lead the result
+            total_count = sum(1 for row in rows if row['project_id'] is None)
+            totals = {row['date']: row['total_minutes'] for row in rows[:total_count]}
+            return rows[total_count:], totals
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def iter_export_records(start_date, end_date, user_id=None):
+        """Yield (date, user_id, email, project_id, project_name, total_minutes) rows.
+        
+        Covers one user, or every user when user_id is None, and only rows
+        with time tracked. Rows are read from the cursor as they are consumed.
+        """
+        user_filter = ' AND t.user_id = ?' if user_id is not None else ''
+        params = (start_date, end_date) + ((user_id,) if user_id is not None else ())
+        
+        conn = get_db_connection()
+        
+        try:
+            cursor = conn.execute(f'''
+                SELECT t.date, t.user_id, u.email, t.project_id, t.project_name, t.total_minutes
+                FROM timesheet t
+                JOIN users u ON u.id = t.user_id
+                WHERE t.date BETWEEN ? AND ?{user_filter} AND t.total_minutes > 0
+                ORDER BY t.date, t.user_id, t.project_id
+            ''', params)
+            
+            for row in cursor:
+                yield tuple(row)
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def get_organisation_export_matrix(start_date, end_date, group_by='user'):
+        """Get every user's cells and per-sheet totals for an organisation export.
+        
+        With group_by='user' each sheet is a user and its rows are projects;
+        with group_by='project' each sheet is a project and its rows are users.
+        Returns (cells, totals): cells are (sheet_id, sheet_name, row_id,
+        row_name, date, total_minutes) rows ordered by sheet, row and date, and
+        totals are (sheet_id, date, total_minutes) rows for days with time.
+        """
+        if group_by == 'user':
+            sheet_id, sheet_name, row_id, row_name = 't.user_id', 'u.email', 't.project_id', 't.project_name'
+        elif group_by == 'project':
+            sheet_id, sheet_name, row_id, row_name = 't.project_id', 't.project_name', 't.user_id', 'u.email'
+        else:
+            raise ValueError(f"Unknown grouping: {group_by}")
+        
+        conn = get_db_connection()
+        
+        try:
+            cells = conn.execute(f'''
+                SELECT {sheet_id} AS sheet_id, {sheet_name} AS sheet_name,
+                       {row_id} AS row_id, {row_name} AS row_name,
+                       t.date, t.total_minutes
+                FROM timesheet t
+                JOIN users u ON u.id = t.user_id
+                WHERE t.date BETWEEN ? AND ?
+                ORDER BY sheet_id, row_id, t.date
+            ''', (start_date, end_date)).fetchall()
+            
+            totals = conn.execute(f'''
+                SELECT {sheet_id} AS sheet_id, t.date, SUM(t.total_minutes) AS total_minutes
+                FROM timesheet t
+                JOIN users u ON u.id = t.user_id
+                WHERE t.date BETWEEN ? AND ? AND t.total_minutes > 0
+                GROUP BY sheet_id, t.date
+            ''', (start_date, end_date)).fetchall()
+            
+            return cells, totals
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def reaggregate(start_date, end_date, user_id=None):
+        """Recompute timesheet totals from the interval log for a date range.
+        
+        Returns the number of timesheet rows inserted, updated or deleted.
+        """
+        conn = get_db_connection()
+        
+        user_filter = ' AND user_id = ?' if user_id is not None else ''
+        params = (start_date, end_date) + ((user_id,) if user_id is not None else ())
+        epsilon = 1e-6
+        
+        try:
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute('BEGIN IMMEDIATE')
+            
+            # Served entirely from idx_time_intervals_date
+            totals = conn.execute(f'''
+                SELECT user_id, date, project_id, MAX(id) AS last_id, SUM(minutes) AS minutes
+                FROM time_intervals
+                WHERE date BETWEEN ? AND ?{user_filter}
+                GROUP BY date, user_id, project_id
+            ''', params).fetchall()
+            
+            existing = {}
+            for row in conn.execute(f'''
+                SELECT id, user_id, date, project_id, total_minutes
+                FROM timesheet
+                WHERE date BETWEEN ? AND ?{user_filter}
+            ''', params):
+                existing[(row['user_id'], row['date'], row['project_id'])] = row
+            
+            changed = 0
+            for total in totals:
+                current = existing.pop((total['user_id'], total['date'], total['project_id']), None)
+                last = conn.execute('''
+                    SELECT project_name, kind FROM time_intervals WHERE id = ?
+                ''', (total['last_id'],)).fetchone()
+                
+                if current is None:
+                    if last['kind'] == 'delete':
+                        continue
+                    conn.execute('''
+                        INSERT INTO timesheet (user_id, date, project_id, project_name, total_minutes)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', (total['user_id'], total['date'], total['project_id'],
+                          last['project_name'], total['minutes']))
+                elif last['kind'] == 'delete':
+                    conn.execute('DELETE FROM timesheet WHERE id = ?', (current['id'],))
+                elif abs(current['total_minutes'] - total['minutes']) > epsilon:
+                    conn.execute('''
+                        UPDATE timesheet
+                        SET total_minutes = ?, last_updated = CURRENT_TIMESTAMP
+                        WHERE id = ?
+                    ''', (total['minutes'], current['id']))
+                else:
+                    continue
+                changed += 1
+            
+            # Rows with no intervals behind them at all
+            for current in existing.values():
+                conn.execute('DELETE FROM timesheet WHERE id = ?', (current['id'],))
+                changed += 1
+            
+            conn.commit()
+            return changed
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def auto_stop_stale_tracking():
+        """Stop timers left running from a previous day.
+        
+        Each timer is logged up to midnight on the day it started. Returns the
+        number of timers stopped.
+        """
+        conn = get_db_connection()
+        today = datetime.now().strftime('%Y-%m-%d')
+        
+        try:
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute('BEGIN IMMEDIATE')
+            
+            # started_at is stored as 'YYYY-MM-DD HH:MM:SS', so a string
+            # comparison finds timers started before today
+            rows = conn.execute('''
+                SELECT user_id, started_at
+                FROM active_tracking
+                WHERE started_at < ?
+            ''', (today,)).fetchall()
+            
+            for row in rows:
+                started_at = datetime.fromisoformat(row['started_at'])
+                midnight = datetime.combine(started_at.date() + timedelta(days=1), datetime.min.time())
+                TimesheetService._finish_active_tracking(
+                    conn, row['user_id'], midnight, started_at.strftime('%Y-%m-%d')
+                )
             
-            return rows
+            conn.commit()
+            return len(rows)
         finally:
             conn.close()
+
+
+def start_auto_stop_task(interval):
+    """Start the background thread that stops timers at midnight (once per process)"""
+    global _auto_stop_thread
+    
+    if interval <= 0 or (_auto_stop_thread and _auto_stop_thread.is_alive()):
+        return
+    
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                stopped = TimesheetService.auto_stop_stale_tracking()
+                if stopped:
+                    print(f"Auto-stopped {stopped} timer(s) left running from a previous day")
+            except sqlite3.Error as e:
+                print(f"Auto-stop error: {e}")
+    
+    _auto_stop_thread = threading.Thread(target=run, name='tracking-auto-stop', daemon=True)
+    _auto_stop_thread.start()
@@ -9,6 +9,7 @@ import base64
 import json
 import secrets
 from ..models.database import get_db_connection
+from ..models.user import invalidate_user_cache
 
 
 class TwoFactorService:
@@ -80,6 +81,7 @@ class TwoFactorService:
                 WHERE id = ?
             ''', (secret, backup_codes_json, user_id))
             conn.commit()
+            invalidate_user_cache(user_id)
             return backup_codes
         finally:
             conn.close()
@@ -95,6 +97,7 @@ class TwoFactorService:
                 WHERE id = ?
             ''', (user_id,))
             conn.commit()
+            invalidate_user_cache(user_id)
         finally:
             conn.close()
     
@@ -3,7 +3,7 @@ User service for user management operations
 """
 
 from ..models.database import get_db_connection
-from ..models.user import hash_password
+from ..models.user import hash_password, invalidate_user_cache
 import secrets
 import string
 import csv
@@ -71,7 +71,7 @@ class UserService:
             # Get total time tracked by all users
             total_time = conn.execute('''
                 SELECT COALESCE(SUM(total_minutes), 0) as total_time_minutes
-                FROM timesheet
+                FROM user_totals
             ''').fetchone()
             
             result = dict(stats) if stats else {
@@ -163,6 +163,7 @@ class UserService:
             ''', params)
             
             conn.commit()
+            invalidate_user_cache(user_id)
             return True, "User updated successfully"
         
         except Exception as e:
@@ -199,6 +200,7 @@ class UserService:
             # In production, you might want to handle this differently
             conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
             conn.commit()
+            invalidate_user_cache(user_id)
             
             return True, f"User {user['email']} deleted successfully"
         
@@ -354,9 +356,9 @@ class UserService:
                        COALESCE(u.password_disabled, 0) as password_disabled,
                        u.microsoft_id,
                        u.display_name,
-                       COALESCE(SUM(t.total_minutes), 0) as total_minutes
+                       COALESCE(ut.total_minutes, 0) as total_minutes
                 FROM users u
-                LEFT JOIN timesheet t ON u.id = t.user_id
+                LEFT JOIN user_totals ut ON u.id = ut.user_id
             '''
             
             # Add WHERE clause based on filter
@@ -370,9 +372,6 @@ class UserService:
                 where_clause = ''
             
             query = base_query + where_clause + '''
-                GROUP BY u.id, u.email, u.is_admin, u.created_at, u.is_disabled, 
-                         u.temp_password, u.auth_method, u.password_disabled, 
-                         u.microsoft_id, u.display_name
                 ORDER BY u.created_at DESC
             '''
             
@@ -401,6 +400,7 @@ class UserService:
             ''', (is_disabled, user_id))
             
             conn.commit()
+            invalidate_user_cache(user_id)
             
             action = "disabled" if is_disabled else "enabled"
             return True, f"User {user['email']} has been {action} successfully"
@@ -0,0 +1,134 @@
+"""
+Response compression and metrics for API blueprints
+
+Negotiates brotli or gzip from Accept-Encoding, compresses both buffered and
+streamed responses, and logs the size and duration of every response.
+"""
+
+import gzip
+import logging
+import time
+import zlib
+from flask import g, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Responses smaller than this are sent as-is; compression would not pay off
+MIN_COMPRESS_SIZE = 1024
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv'}
+
+
+def choose_encoding(accept_encodings):
+    """Pick the best supported content coding the client accepts, or None"""
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def _compress(data, encoding):
+    """Compress a complete response body"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+
+def _compress_stream(chunks, encoding, on_close):
+    """Compress a streamed body chunk by chunk"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        # wbits=31 writes a gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+
+    raw_size = sent_size = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            raw_size += len(chunk)
+            compressed = compress(chunk)
+            if compressed:
+                sent_size += len(compressed)
+                yield compressed
+        tail = finish()
+        sent_size += len(tail)
+        yield tail
+    finally:
+        on_close(raw_size, sent_size)
+
+
+def _count_stream(chunks, on_close):
+    """Pass a streamed body through unchanged, counting its size"""
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        on_close(size, size)
+
+
+def init_compression(blueprint):
+    """Register compression and metrics hooks on a blueprint"""
+
+    @blueprint.before_request
+    def start_response_timer():
+        g.response_timer_started = time.perf_counter()
+
+    @blueprint.after_request
+    def compress_response(response):
+        started = g.get('response_timer_started', time.perf_counter())
+        method, path, status = request.method, request.path, response.status_code
+
+        def log_metrics(raw_size, sent_size, encoding):
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            logger.info(
+                f"{method} {path} {status} raw={raw_size}B sent={sent_size}B "
+                f"encoding={encoding or 'identity'} time={elapsed_ms:.1f}ms"
+            )
+
+        response.vary.add('Accept-Encoding')
+
+        encoding = None
+        if (status == 200
+                and not response.direct_passthrough
+                and 'Content-Encoding' not in response.headers
+                and response.mimetype in COMPRESSIBLE_MIMETYPES):
+            encoding = choose_encoding(request.accept_encodings)
+
+        if response.is_streamed:
+            on_close = lambda raw, sent: log_metrics(raw, sent, encoding)
+            if encoding:
+                response.response = _compress_stream(response.response, encoding, on_close)
+                response.headers['Content-Encoding'] = encoding
+                response.headers.pop('Content-Length', None)
+            else:
+                response.response = _count_stream(response.iter_encoded(), on_close)
+            return response
+
+        if response.direct_passthrough:
+            return response
+
+        data = response.get_data()
+        raw_size = len(data)
+
+        if encoding and raw_size >= MIN_COMPRESS_SIZE:
+            response.set_data(_compress(data, encoding))
+            response.headers['Content-Encoding'] = encoding
+        else:
+            encoding = None
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        response.headers['Server-Timing'] = f'app;dur={elapsed_ms:.1f}'
+        log_metrics(raw_size, response.content_length, encoding)
+        return response
@@ -0,0 +1,45 @@
+"""
+Conditional GET support for read-only endpoints
+"""
+
+from flask import request, make_response
+from functools import wraps
+from datetime import date
+import hashlib
+from ..models.database import get_data_versions
+
+
+def etag_from_data_versions(*tables):
+    """Decorator that answers If-None-Match with 304 when the data is unchanged.
+
+    The ETag is derived from the data_versions counters of the given tables,
+    the query string and today's date (for endpoints that report relative
+    ranges such as the last 30 days). It is checked before the view runs, so
+    an unchanged refresh costs a single indexed lookup.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            versions = get_data_versions(*tables)
+            fingerprint = '|'.join([
+                request.endpoint,
+                request.query_string.decode(),
+                date.today().isoformat(),
+                *map(str, versions)
+            ])
+            etag = hashlib.sha1(fingerprint.encode()).hexdigest()[:20]
+
+            # Weak because the body is re-encoded per Accept-Encoding
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+                response.set_etag(etag, weak=True)
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag, weak=True)
+                response.headers['Cache-Control'] = 'no-cache'
+            return response
+
+        return decorated_function
+    return decorator
@@ -0,0 +1,73 @@
+"""
+Date range, format and grouping parsing for export endpoints
+"""
+
+from flask import request
+from datetime import datetime
+
+
+def get_export_range():
+    """Read and validate start_date/end_date from JSON or form data.
+
+    Returns (start_date, end_date, error_message).
+    """
+    # Handle both JSON and form data
+    if request.is_json:
+        data = request.get_json()
+        start_date = data.get('start_date') if data else None
+        end_date = data.get('end_date') if data else None
+    else:
+        # Handle form data
+        start_date = request.form.get('start_date')
+        end_date = request.form.get('end_date')
+
+    if not start_date or not end_date:
+        return None, None, 'Please provide both start and end dates'
+
+    try:
+        # Validate date format
+        datetime.strptime(start_date, '%Y-%m-%d')
+        datetime.strptime(end_date, '%Y-%m-%d')
+    except ValueError:
+        return None, None, 'Invalid date format'
+
+    if start_date > end_date:
+        return None, None, 'Start date must be before end date'
+
+    return start_date, end_date, None
+
+
+def get_export_format(formats):
+    """Read the requested export format from JSON or form data, defaulting to xlsx.
+
+    Returns (file_format, error_message).
+    """
+    if request.is_json:
+        data = request.get_json()
+        file_format = data.get('format') if data else None
+    else:
+        file_format = request.form.get('format')
+
+    file_format = file_format or 'xlsx'
+    if file_format not in formats:
+        return None, f'Unsupported export format: {file_format}'
+
+    return file_format, None
+
+
+def get_export_group_by():
+    """Read the organisation export grouping from JSON or form data, defaulting to user.
+
+    Returns (group_by, error_message).
+    """
+    if request.is_json:
+        data = request.get_json()
+        group_by = data.get('group_by') if data else None
+    else:
+        group_by = request.form.get('group_by')
+
+    group_by = group_by or 'user'
+    if group_by not in ('user', 'project'):
+        return None, 'Group by must be user or project'
+
+    return group_by, None
@@ -0,0 +1,45 @@
+"""
+Fast JSON serialization for Timesheet Tracker
+
+Uses orjson when it is installed and falls back to the standard library
+otherwise, so the dependency stays optional.
+"""
+
+import json
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """Serialize plain data (dicts, lists, strings, numbers) to a JSON string"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, separators=(',', ':'))
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that serializes with orjson when available"""
+
+    def dumps(self, obj, **kwargs):
+        """Serialize data as JSON, keeping Flask's handling of dates and other types"""
+        if orjson is None or 'cls' in kwargs:
+            return super().dumps(obj, **kwargs)
+
+        # Datetimes go through Flask's default so they keep the HTTP date
+        # format existing clients expect
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+
+        try:
+            return orjson.dumps(obj, default=self.default, option=option).decode()
+        except TypeError:
+            # orjson rejects a few values the stdlib accepts (e.g. integers
+            # wider than 64 bits)
+            return super().dumps(obj, **kwargs)
@@ -1,5 +1,15 @@
-workers = 1
-worker_class = "sync"
+import multiprocessing
+import os
+
+# Tracking state is stored in the database, so any number of workers can
+# serve the same user
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# Threaded workers so open /tracking_events streams do not each tie up a
+# whole worker process. Every browser tab on the timer page holds one thread
+# for up to 5 minutes per stream; EVENT_MAX_STREAMS (default 4) caps streams
+# per worker below this so other requests keep threads, and refused tabs poll
+worker_class = "gthread"
+threads = int(os.getenv('GUNICORN_THREADS', 8))
 timeout = 5000
 worker_connections = 1000
-bind = "0.0.0.0:8000"
\ No newline at end of file
+bind = "0.0.0.0:8000"
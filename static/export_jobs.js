@@ -0,0 +1,31 @@
+/**
+ * Background export job polling, shared by the timesheet and admin pages
+ */
+
+/**
+ * Poll an export job's status URL once a second until it finishes.
+ * Resolves with the finished job, or rejects once it fails or after maxPolls
+ * (15 minutes, the server's default EXPORT_JOB_TIMEOUT)
+ */
+function waitForExport(statusUrl, maxPolls = 900) {
+    return new Promise((resolve, reject) => {
+        let polls = 0;
+        const poll = () => {
+            fetch(statusUrl)
+                .then(response => response.json())
+                .then(job => {
+                    if (job.status === 'done') {
+                        resolve(job);
+                    } else if (job.status === 'failed' || !job.success) {
+                        reject(new Error(job.message || 'Export failed'));
+                    } else if (++polls >= maxPolls) {
+                        reject(new Error('Export is taking too long, please try again later'));
+                    } else {
+                        setTimeout(poll, 1000);
+                    }
+                })
+                .catch(reject);
+        };
+        poll();
+    });
+}
@@ -0,0 +1,17 @@
+"""
+Shared test setup: point the app at a throwaway database before it is imported
+"""
+
+import os
+import sys
+import tempfile
+
+_tmp_dir = tempfile.mkdtemp(prefix='timesheet-tests-')
+
+os.environ['DATABASE'] = os.path.join(_tmp_dir, 'timesheet.db')
+os.environ['EXPORT_DIR'] = os.path.join(_tmp_dir, 'exports')
+os.environ['EXPORT_CACHE_DIR'] = os.path.join(_tmp_dir, 'export-cache')
+os.environ['ADMIN_EMAIL'] = 'admin@example.com'
+os.environ['ADMIN_PASSWORD'] = 'admin-password'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,48 @@
+"""
+ConnectionPool: idle connections are reused, and checkouts beyond
+max_connections wait for a release or time out.
+"""
+
+import sqlite3
+import threading
+
+import pytest
+
+from app.models.database import ConnectionPool
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), max_size=1, max_connections=2, timeout=0.2)
+    yield pool
+    pool.close_all()
+
+
+def test_released_connection_is_reused(pool):
+    conn = pool.acquire()
+    pool.release(conn)
+    assert pool.acquire() is conn
+
+
+def test_checkouts_beyond_the_limit_time_out(pool):
+    held = [pool.acquire(), pool.acquire()]
+    with pytest.raises(sqlite3.OperationalError):
+        pool.acquire()
+
+    # Releasing one, even past the idle limit, frees a checkout
+    for conn in held:
+        pool.release(conn)
+    pool.release(pool.acquire())
+
+
+def test_waiting_checkout_gets_a_released_connection(pool):
+    held = [pool.acquire(), pool.acquire()]
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+    waiter.start()
+    pool.release(held.pop())
+    waiter.join()
+
+    assert len(acquired) == 1
+    pool.release(acquired[0])
+    pool.release(held.pop())